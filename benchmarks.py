@@ -0,0 +1,251 @@
+'''
+Benchmarks for the City Compare app (city_comparing.py).
+
+Usage:
+    python benchmarks.py parse [--repeat 3] [page.html ...]
+    python benchmarks.py stats [--repeat 1000] [city ...]
+    python benchmarks.py load [--url URL] [--clients 1 2 4 8] [--requests 400] [--barplot] [city ...]
+'''
+import argparse
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+import city_comparing
+
+
+def get_saved_pages(html_files):
+    '''Get saved eventbrite pages, either from HTML files or from the request cache.
+
+    Parameters
+    ----------
+    html_files: list
+        paths of saved eventbrite pages (empty -> use the raw pages in the cache)
+
+    Returns
+    -------
+    list
+        a list of HTML texts
+    '''
+    pages = []
+
+    if html_files:
+        for html_file in html_files:
+            with open(html_file, 'r', encoding='utf-8') as fr:
+                pages.append(fr.read())
+        return pages
+
+    cache = city_comparing.open_cache()
+    for key in cache.keys():
+        if city_comparing.get_cache_source(key) != 'yelp':
+            value = cache.get(key)
+            # Only raw pages (entries cached with CACHE_STORE_EXTRACTED are already scraped)
+            if isinstance(value, str):
+                pages.append(value)
+    return pages
+
+
+def benchmark_parse(args):
+    '''Compare the full page parse with the fast (restricted) parse of parse_event_page.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        html_files and repeat
+
+    Returns
+    -------
+    None
+    '''
+    pages = get_saved_pages(args.html_files)
+    if not pages:
+        print("No saved eventbrite pages. Crawl once or pass HTML files.")
+        return
+
+    timings = {}
+    results = {}
+    for fast in [False, True]:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results[fast] = [list(city_comparing.parse_event_page(page, fast=fast)) for page in pages]
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        timings[fast] = best
+
+    total_events = sum(len(page_events) for page_events in results[True])
+    print(f"pages: {len(pages)}, events: {total_events}, fast parser: {city_comparing.EVENT_PAGE_PARSER}")
+    print(f"full parse (html.parser): {timings[False]:.3f} s ({timings[False] / len(pages) * 1000:.1f} ms/page)")
+    print(f"fast parse:               {timings[True]:.3f} s ({timings[True] / len(pages) * 1000:.1f} ms/page)")
+    print(f"speedup: {timings[False] / timings[True]:.1f}x")
+    print(f"same events: {results[False] == results[True]}")
+
+
+# The results page queries before CityStats: aggregates computed from the raw tables on every request
+RAW_STATS_QUERIES = {
+    'total_number_of_restaurants': '''
+        SELECT COUNT(*), Locations.City FROM Restaurants JOIN Locations ON Restaurants.LocationId = Locations.Id
+        WHERE Locations.City = ?
+    ''',
+    'average_restaurant_rating': '''
+        SELECT AVG(Restaurants.Rating), Locations.City FROM Restaurants JOIN Locations ON Restaurants.LocationId = Locations.Id
+        WHERE Locations.City = ?
+    ''',
+    'total_number_of_events': '''
+        SELECT COUNT(*), Locations.City FROM Events JOIN Locations ON Events.LocationId = Locations.Id
+        WHERE Locations.City = ?
+    ''',
+    'total_number_of_events_on_weekend': '''
+        SELECT COUNT(*), Locations.City FROM Events JOIN Locations ON Events.LocationId = Locations.Id
+        WHERE Locations.City = ? AND (Events.Day = "Sat" or Events.Day = "Sun")
+    ''',
+    'total_number_of_events_on_weekday': '''
+        SELECT COUNT(*), Locations.City FROM Events JOIN Locations ON Events.LocationId = Locations.Id
+        WHERE Locations.City = ? AND (Events.Day != "Sat" AND Events.Day != "Sun")
+    ''',
+}
+
+def benchmark_stats(args):
+    '''Compare the raw aggregate queries with the CityStats point reads for every data selection.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        cities and repeat
+
+    Returns
+    -------
+    None
+    '''
+    conn = sqlite3.connect(city_comparing.DB_NAME)
+    cur = conn.cursor()
+
+    # Only the queries are timed
+    city_names = [city_comparing.capitalize_city_name(a_city) for a_city in args.cities]
+    location_ids = [city_comparing.resolve_location_id(a_city, 'MI') for a_city in args.cities]
+
+    print(f"{'data selection':<36}{'raw (ms)':>10}{'CityStats (ms)':>16}{'speedup':>9}")
+    for data_selection, raw_query in RAW_STATS_QUERIES.items():
+        stats_query = f"SELECT {city_comparing.DATA_SELECTION_COLUMNS[data_selection][0]} FROM CityStats WHERE LocationId = ?"
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for city_name in city_names:
+                cur.execute(raw_query, [city_name]).fetchall()
+        raw_time = (time.perf_counter() - start) / args.repeat
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for location_id in location_ids:
+                cur.execute(stats_query, [location_id]).fetchone()
+        stats_time = (time.perf_counter() - start) / args.repeat
+
+        print(f"{data_selection:<36}{raw_time * 1000:>10.3f}{stats_time * 1000:>16.3f}{raw_time / stats_time:>8.1f}x")
+
+    conn.close()
+
+
+def start_local_server():
+    '''Serve the Flask app with a threaded werkzeug server on a free local port (in a daemon thread).
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        the base url of the server, i.e. "http://127.0.0.1:53211"
+    '''
+    city_comparing.create_db()
+    city_comparing.load_locations()
+    city_comparing.get_city_index()
+
+    # No access log line per request
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, city_comparing.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def benchmark_load(args):
+    '''Measure the results page throughput (requests per second) for growing numbers of concurrent clients.
+    Every client posts its own city, so the requests only share the database.
+    Pass --url to test a server started separately, i.e. "gunicorn -w 4 city_comparing:app".
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        url, clients, requests, selection, barplot and cities
+
+    Returns
+    -------
+    None
+    '''
+    base_url = args.url or start_local_server()
+    category = 'restaurants' if args.selection in city_comparing.RESTAURANT_DATA_SELECTIONS else 'events'
+    results_url = f"{base_url}/category/{category}/results"
+
+    sessions = threading.local()
+
+    def post_results(request_number):
+        session = getattr(sessions, 'session', None)
+        if session is None:
+            session = requests.Session()
+            sessions.session = session
+        a_city = args.cities[request_number % len(args.cities)]
+        form = {'user_city': a_city, 'category_radio': args.selection}
+        if args.barplot:
+            form['barplot'] = 'on'
+        response = session.post(results_url, data=form)
+        return response.status_code == 200
+
+    # Warm up (connections, caches, prefetch jobs of the cities)
+    for request_number in range(len(args.cities)):
+        post_results(request_number)
+
+    print(f"{'clients':>8}{'requests/s':>12}{'ms/request':>12}{'errors':>8}")
+    for clients in args.clients:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            statuses = list(executor.map(post_results, range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+        print(f"{clients:>8}{args.requests / elapsed:>12.1f}{elapsed / args.requests * clients * 1000:>12.2f}{statuses.count(False):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="City Compare benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parse_parser = subparsers.add_parser('parse', help="eventbrite page parsing (full vs fast)")
+    parse_parser.add_argument('html_files', nargs='*', help="saved eventbrite pages (default: pages in the cache)")
+    parse_parser.add_argument('--repeat', type=int, default=3)
+    parse_parser.set_defaults(func=benchmark_parse)
+
+    stats_parser = subparsers.add_parser('stats', help="results page queries (raw tables vs CityStats)")
+    stats_parser.add_argument('cities', nargs='*', default=['detroit', 'ann arbor'], help="lower cased cities")
+    stats_parser.add_argument('--repeat', type=int, default=1000)
+    stats_parser.set_defaults(func=benchmark_stats)
+
+    load_parser = subparsers.add_parser('load', help="results page throughput with concurrent clients")
+    load_parser.add_argument('cities', nargs='*', default=['Ann Arbor', 'Lansing', 'Flint', 'Grand Rapids'], help="cities of the clients")
+    load_parser.add_argument('--url', help="base url of a running server (default: start a threaded local server)")
+    load_parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4, 8])
+    load_parser.add_argument('--requests', type=int, default=400)
+    load_parser.add_argument('--selection', default='total_number_of_events')
+    load_parser.add_argument('--barplot', action='store_true', help="request the bar graph instead of the table")
+    load_parser.set_defaults(func=benchmark_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,81 +1,334 @@
+import argparse
+import atexit
 import datetime
+import hashlib
+import importlib.util
+import re
 import requests
-from bs4 import BeautifulSoup
 import json
+import os
 import secrets
 import csv
 import sqlite3
 import time
-from flask import Flask, render_template, request
-import plotly.graph_objects as go
+import threading
+import queue
+import zlib
+import multiprocessing
+import heapq
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from itertools import islice, takewhile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import closing, contextmanager
+from pathlib import Path
+from urllib.parse import urlsplit
+from flask import Flask, render_template, request, jsonify, g, has_app_context
+# bs4 and plotly are imported where they are used, so the app can start serving without loading them
 
 # For Caching
+# "sqlite" -> indexed on-disk cache (CACHE_DB_FILENAME), "memory" -> plain dictionary for this process only
+CACHE_BACKEND = "sqlite"
+CACHE_DB_FILENAME = "cache.sqlite"
+# Legacy whole-file JSON cache, migrated once into the SQLite cache
 CACHE_FILENAME = "cache.json"
 CACHE_DICT = {}
+# Expiry policy per source in seconds (see get_cache_source). Eventbrite pages say "Today"/"Tomorrow",
+# so they go stale quickly; Yelp search results change slowly.
+CACHE_TTL_SECONDS = {
+    'eventbrite': 3 * 60 * 60,
+    'yelp': 7 * 24 * 60 * 60,
+}
+DEFAULT_CACHE_TTL_SECONDS = 24 * 60 * 60
+# Maximum size of the cached values; the least recently used entries are evicted above it
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# zlib level used to compress the cached values (0 -> stored uncompressed)
+CACHE_COMPRESSION_LEVEL = 6
+# The access times of the cache hits (for the LRU eviction) are written in batches of this size,
+# or with the next write, instead of one transaction per hit
+CACHE_ACCESS_BATCH_SIZE = 100
+# True -> cache only the fields scraped/used from a page or an API response instead of the raw result
+CACHE_STORE_EXTRACTED = False
 
 # For Database
 DB_NAME = "city_compare.sqlite"
+# Prebuilt copy of the database written by "build-snapshot" and served by "serve" (see main)
+DB_SNAPSHOT_FILENAME = "city_compare_snapshot.sqlite"
+# True -> DB_NAME is a read-only snapshot: no migrations, loads, prefetch jobs or refreshes
+DB_READ_ONLY = False
+# Number of rows written per executemany call
+DB_INSERT_BATCH_SIZE = 500
+# Data older than this (in seconds) is fetched again (see needs_refresh)
+RESTAURANT_REFRESH_SECONDS = 7 * 24 * 60 * 60
+EVENT_REFRESH_SECONDS = 3 * 60 * 60
+# City name used in LoadStatus for data loaded for a whole state (i.e. the Eventbrite crawl)
+ALL_CITIES = "*"
+# Event days counted as weekend in CityStats
+WEEKEND_DAYS = ('Sat', 'Sun')
+
+# Data selections of the results page -> CityStats expression, and the value of a city without data
+DATA_SELECTION_COLUMNS = {
+    'total_number_of_events': ('TotalEvents', 0),
+    'total_number_of_events_on_weekend': ('WeekendEvents', 0),
+    'total_number_of_events_on_weekday': ('WeekdayEvents', 0),
+    'total_number_of_restaurants': ('RestaurantCount', 0),
+    'average_restaurant_rating': ('RatingSum / NULLIF(RatedCount, 0)', None),
+}
+RESTAURANT_DATA_SELECTIONS = ('total_number_of_restaurants', 'average_restaurant_rating')
+
+# Connections (see get_db_connection and db_writer)
+# Read connections of the threads outside of Flask, and idle read connections of the Flask requests
+DB_CONNECTIONS = threading.local()
+DB_READ_POOL = queue.LifoQueue()
+DB_READ_POOL_SIZE = 16
+# Every write of this process goes through one connection, one transaction at a time
+DB_WRITER = None
+DB_WRITE_LOCK = threading.Lock()
+# Seconds a connection waits for a lock held by another process before "database is locked"
+DB_BUSY_TIMEOUT_SECONDS = 30
+# SQLite page cache per connection in KiB
+DB_CACHE_SIZE_KB = 16000
+
+# (normalized city, normalized state) -> Locations.Id, loaded once (see get_location_ids)
+LOCATION_IDS = {}
+LOCATION_IDS_LOCK = threading.Lock()
 
 # For Event
-MICHIGAN_EVENT_URL= 'https://www.eventbrite.com/d/united-states--michigan/all-events/'
-
-event_names = []
-
-event_calendar = []
-event_day = []
-event_date = []
-event_time = []
-
-event_location = []
-event_city = []
-event_state = []
-
-# Event Crawling Numbers for Michigan (State)
-state_event_crawling_numbers = 52
+# Eventbrite listing of a state (see get_state_event_url), i.e. michigan -> .../united-states--michigan/all-events/
+EVENTBRITE_STATE_URL = 'https://www.eventbrite.com/d/united-states--{state_slug}/all-events/'
+EVENT_STATE_SLUGS = {
+    'AL': 'alabama', 'AK': 'alaska', 'AZ': 'arizona', 'AR': 'arkansas', 'CA': 'california',
+    'CO': 'colorado', 'CT': 'connecticut', 'DE': 'delaware', 'DC': 'district-of-columbia', 'FL': 'florida',
+    'GA': 'georgia', 'HI': 'hawaii', 'ID': 'idaho', 'IL': 'illinois', 'IN': 'indiana',
+    'IA': 'iowa', 'KS': 'kansas', 'KY': 'kentucky', 'LA': 'louisiana', 'ME': 'maine',
+    'MD': 'maryland', 'MA': 'massachusetts', 'MI': 'michigan', 'MN': 'minnesota', 'MS': 'mississippi',
+    'MO': 'missouri', 'MT': 'montana', 'NE': 'nebraska', 'NV': 'nevada', 'NH': 'new-hampshire',
+    'NJ': 'new-jersey', 'NM': 'new-mexico', 'NY': 'new-york', 'NC': 'north-carolina', 'ND': 'north-dakota',
+    'OH': 'ohio', 'OK': 'oklahoma', 'OR': 'oregon', 'PA': 'pennsylvania', 'RI': 'rhode-island',
+    'SC': 'south-carolina', 'SD': 'south-dakota', 'TN': 'tennessee', 'TX': 'texas', 'UT': 'utah',
+    'VT': 'vermont', 'VA': 'virginia', 'WA': 'washington', 'WV': 'west-virginia', 'WI': 'wisconsin',
+    'WY': 'wyoming',
+}
+# States whose events are crawled at startup and by the refresh scheduler (see refresh_events)
+EVENT_CRAWL_STATES = ['MI']
+
+# The crawl of a state stops after EVENT_CRAWL_EMPTY_PAGES pages in a row without events (past the last page),
+# or at EVENT_CRAWL_MAX_PAGES pages
+EVENT_CRAWL_MAX_PAGES = 200
+EVENT_CRAWL_EMPTY_PAGES = 2
+# States crawled at the same time, one process each (see crawl_states)
+EVENT_CRAWL_MAX_PROCESSES = 4
+# Event batches (of DB_INSERT_BATCH_SIZE events) waiting between the crawl processes and the database inserts
+EVENT_PIPELINE_QUEUE_SIZE = 8
+# Seconds between two checks of the other side of the pipeline (a dead worker, a stopped crawl)
+EVENT_PIPELINE_POLL_SECONDS = 0.5
+# Queue of a crawl_states worker process, and the event set when crawl_states stops early (see init_crawl_worker)
+EVENT_BATCH_QUEUE = None
+EVENT_CRAWL_STOP = None
+
+# Fast scraping: only the event card nodes are parsed (see parse_event_page),
+# with lxml when it is installed (it is not required)
+EVENT_FAST_PARSE = True
+if importlib.util.find_spec('lxml') is not None:
+    EVENT_PAGE_PARSER = "lxml"
+else:
+    EVENT_PAGE_PARSER = "html.parser"
+# Nodes built by the fast parse (a bs4 SoupStrainer of these tags and classes)
+EVENT_CARD_TAGS = ['article', 'div']
+EVENT_CARD_CLASS = re.compile(r'(^|\s)(eds-media-card-content|search-event-card-square-image)(\s|$)')
+
+# Number of pages fetched at the same time while crawling (1 -> serial crawl)
+CRAWL_MAX_WORKERS = 8
+
+# Politeness budget per host: (requests per second, max requests in flight)
+# This replaces the blanket 1 second sleep after every scraped page.
+HOST_POLITENESS = {
+    'www.eventbrite.com': (5, 4),
+}
+DEFAULT_HOST_POLITENESS = (20, 8)
+HOST_THROTTLES = {}
+HOST_THROTTLES_LOCK = threading.Lock()
 
 # For Restaurant
 YELP_API_URL="https://api.yelp.com/v3/businesses/search"
 YELP_API_KEY = secrets.YELP_API_KEY
+# Yelp returns at most 50 businesses per request and at most 1000 businesses per search
+YELP_PAGE_LIMIT = 50
+YELP_MAX_RESULTS = 1000
+# Number of offset requests sent to Yelp at the same time
+YELP_MAX_WORKERS = 8
+# Error codes of a search that has no businesses (every other error fails the fetch, see YelpError)
+YELP_NO_BUSINESSES_ERRORS = ('LOCATION_NOT_FOUND',)
+
+# Pooled HTTP session shared by every request (keep-alive connections per host)
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max(CRAWL_MAX_WORKERS, YELP_MAX_WORKERS)))
+
+# Background restaurant prefetch started when the user's city is checked (see prefetch_restaurants)
+PREFETCH_MAX_WORKERS = 2
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=PREFETCH_MAX_WORKERS, thread_name_prefix='prefetch')
+# (city, state) -> (executor, Future) of the last prefetch job of the city
+PREFETCH_JOBS = {}
+PREFETCH_JOBS_LOCK = threading.Lock()
+# Seconds the results page waits for a running job before showing a loading page that polls it
+PREFETCH_WAIT_SECONDS = 10
+# A running job is also recorded in LoadStatus under this source, so the other processes serving the app
+# (i.e. gunicorn workers) see it and do not start the same job. Older records are left by a stopped process.
+PREFETCH_CLAIM_SOURCE = 'yelp-prefetch'
+PREFETCH_CLAIM_SECONDS = 10 * 60
+
+# Background refresh of the events and the loaded cities' restaurants while the app is serving
+# (see start_refresh_scheduler). Seconds between two checks of the data age.
+REFRESH_INTERVAL_SECONDS = 15 * 60
+# Cities whose restaurants are fetched at the same time by the statewide precompute (see precompute_restaurants);
+# the Yelp requests of all of them share the politeness budget of the host (HOST_POLITENESS)
+PRECOMPUTE_MAX_WORKERS = 4
+# One events refresh at a time (see refresh_events)
+EVENT_REFRESH_LOCK = threading.Lock()
+# Stale events are only deleted if the crawl saw at least this share of the stored events
+# (a partly failed crawl must not empty the table)
+EVENT_PRUNE_MIN_RATIO = 0.5
+# The same for the stored restaurants of a city and its last fetch (see delete_stale_restaurants)
+RESTAURANT_PRUNE_MIN_RATIO = 0.5
+# The restaurant refreshes have their own thread and at most REFRESH_MAX_CITIES cities (the oldest) are
+# queued per run, so the refresh of every precomputed city does not hold up the prefetch of a user's city
+REFRESH_MAX_CITIES = 50
+REFRESH_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='refresh-prefetch')
 
 # For US Cities
 # Reference: The uscities csv file was downloaded from https://simplemaps.com/data/us-cities.
 US_CITIES = "uscities.csv"
+# Cities per state, built once from US_CITIES (see get_city_index)
+CITY_INDEX = None
+CITY_INDEX_LOCK = threading.Lock()
+# Ranking of a city without a "ranking" value (the CSV uses 1 to 5, 1 is the most important)
+CITY_DEFAULT_RANKING = 5
+# Maximum number of autocomplete suggestions
+CITY_SUGGESTIONS_LIMIT = 10
+# The best suggestions of prefixes up to this length are computed when the index is built
+# (short prefixes match too many cities to rank them on every keystroke)
+CITY_PREFIX_CACHE_LENGTH = 3
 
 # For Flask
+# The user's city is carried by the pages in a hidden "user_city" form field (no global state),
+# so the app can be served by many threads or processes
 app = Flask(__name__)
 
-# User's city to be retrieved later
-user_city = []
+# Rendered results pages: (user's city, data selection, barplot) -> (CityStats version, html), least recently used first
+RESULTS_CACHE = OrderedDict()
+RESULTS_CACHE_SIZE = 512
+RESULTS_CACHE_LOCK = threading.Lock()
+# plotly.js is served by the app once (see plotly_js) and cached by the browsers, instead of inlined in every graph
+PLOTLY_JS = None
+PLOTLY_JS_MAX_AGE_SECONDS = 365 * 24 * 60 * 60
+
+# Batch comparison (see compare_city_batch): maximum number of cities per request, and seconds
+# a request waits for the restaurant prefetch jobs of its cities
+COMPARE_MAX_CITIES = 50
+COMPARE_WAIT_SECONDS = 30
+# The prefetch jobs of the batch comparisons have their own threads, so a batch of many cities
+# does not hold up the prefetch of a single user's city (PREFETCH_EXECUTOR)
+COMPARE_PREFETCH_MAX_WORKERS = 2
+COMPARE_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=COMPARE_PREFETCH_MAX_WORKERS, thread_name_prefix='compare-prefetch')
 
 '''
 Part 1: Data Collection
 '''
 # Part1 - Eventbrite
-# Scraping each page
-def get_event_information(a_page_url):
-    '''Get event information and store it in each event lists.
+class EventRecord:
+    '''One event scraped from an eventbrite page.
 
     Parameters
     ----------
-    a_page_url: string
-        The URL for an eventbrite url
-        i.e. (first page)  https://www.eventbrite.com/d/united-states--michigan/all-events/
-        i.e. (second page) https://www.eventbrite.com/d/united-states--michigan/all-events/?page=2
+    name: string
+        i.e. 'Drag Queen Bingo - Bus Stop Bar and Grille'
+    location: string
+        i.e. 'The Bus Stop Bar & Grille'
+    city: string
+        i.e. ' Birch Run'
+    state: string
+        i.e. 'MI'
+    day: string
+        i.e. 'Thu'
+    date: string
+        i.e. 'Apr 16'
+    time: string
+        i.e. '8:00 PM'
+    '''
+    __slots__ = ('name', 'location', 'city', 'state', 'day', 'date', 'time')
+
+    def __init__(self, name, location, city, state, day, date, time):
+        self.name = name
+        self.location = location
+        self.city = city
+        self.state = state
+        self.day = day
+        self.date = date
+        self.time = time
+
+    def to_list(self):
+        return [getattr(self, field) for field in self.__slots__]
+
+    def get_key(self):
+        '''Identity of the event, used to upsert it into the Events table.
+        The same listing scraped again (same name, place, date and time) gets the same key.
+
+        Returns
+        -------
+        string
+            sha1 hex digest of the normalized fields
+        '''
+        fields = [self.name, self.location, self.city, self.state, self.date, self.time]
+        return hashlib.sha1("|".join(normalize_location_name(field) for field in fields).encode('utf-8')).hexdigest()
 
-    Returns
-    -------
-    none
+    def __eq__(self, other):
+        return isinstance(other, EventRecord) and self.to_list() == other.to_list()
+
+    def __repr__(self):
+        return f"EventRecord({', '.join(repr(value) for value in self.to_list())})"
+
+
+# Scraping each page
+def parse_event_page(response, fast=None):
+    '''Scrape the events of one eventbrite page.
+
+    Parameters
+    ----------
+    response: string
+        HTML text of an eventbrite page
+    fast: bool
+        True -> only build the event card nodes (EVENT_CARD_TAGS, EVENT_CARD_CLASS) with EVENT_PAGE_PARSER,
+        False -> build the whole page with "html.parser".
+        Defaults to EVENT_FAST_PARSE. Both give the same events.
+
+    Yields
+    ------
+    EventRecord
+        the events of the page in the page order
     '''
-    response = make_request_with_cache(a_page_url)
-    soup = BeautifulSoup(response, "html.parser")
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    if fast is None:
+        fast = EVENT_FAST_PARSE
+
+    if fast:
+        soup = BeautifulSoup(response, EVENT_PAGE_PARSER, parse_only=SoupStrainer(EVENT_CARD_TAGS, class_=EVENT_CARD_CLASS))
+    else:
+        soup = BeautifulSoup(response, "html.parser")
     '''
     For event name, location, and price
     '''
+    # i.e. [('Drag Queen Bingo - Bus Stop Bar and Grille', 'The Bus Stop Bar & Grille', ' Birch Run', 'MI'), ...]
+    event_headers = []
+
     header_div = soup.find_all('article', class_='eds-l-pad-all-4 eds-media-card-content eds-media-card-content--list eds-media-card-content--standard eds-media-card-content--fixed eds-l-pad-vert-3')
     for item in header_div:
         # Event name
         an_event = item.find('div', class_='eds-event-card__formatted-name--is-clamped eds-event-card__formatted-name--is-clamped-three eds-text-weight--heavy', role='presentation').text.strip()
-        event_names.append(an_event)
+
+        location = "Location Not Available"
+        city = "City Not Available"
+        state = "Stat Not Available"
 
         # Event Location: location name, city, state
         if item.find('div', class_='eds-media-card-content__sub-content'):
@@ -86,149 +339,522 @@ def get_event_information(a_page_url):
                     # Location i.e. "Brightmoor Christian Church • Novi, MI"
                     # Location Name
                     location_split = location.split(" •")
-                    event_location.append(location_split[0])
-                    # Online Event
-                    if len(location_split[1].strip().split(", ")) <= 1:
-                        city = "City Not Available"
-                        state = "Stat Not Available"
-                        event_city.append(city)
-                        event_state.append(state)
-                    else:
-                        # City
+                    location = location_split[0]
+                    # Online Event -> city and state are not available
+                    if len(location_split[1].strip().split(", ")) > 1:
                         city_split = location_split[1].strip().split(", ")
-                        event_city.append(city_split[0])
+                        # City
+                        city = city_split[0]
                         # State
-                        event_state.append(city_split[1])
-                else:
-                    # Location i.e. "Fisherman's Landing Launch and Campground"
-                    event_location.append(location)
-                    city = "City Not Available"
-                    state = "Stat Not Available"
-                    event_city.append(city)
-                    event_state.append(state)
-            else:
-                location = "Location Not Available"
-                city = "City Not Available"
-                state = "Stat Not Available"
-                event_location.append(location)
-                event_city.append(city)
-                event_state.append(state)
-        else:
-            location = "Location Not Available"
-            city = "City Not Available"
-            state = "Stat Not Available"
-            event_location.append(location)
-            event_city.append(city)
-            event_state.append(state)
+                        state = city_split[1]
+                # else: Location i.e. "Fisherman's Landing Launch and Campground"
+
+        event_headers.append((an_event, location, city, state))
 
     '''
     For calendar
     '''
     calendar_price_container = soup.find_all('div', class_='search-event-card-square-image')
-    for item in calendar_price_container:
+
+    # Both lists describe the same event cards. If the counts differ the events
+    # cannot be matched, so skip the page instead of mixing up events.
+    if len(event_headers) != len(calendar_price_container):
+        print(f"Skipping page: {len(event_headers)} event headers but {len(calendar_price_container)} calendars")
+        return
+
+    for event_header, item in zip(event_headers, calendar_price_container):
         # Event Calendar
         calendar = item.find('div', class_='eds-text-color--primary-brand eds-l-pad-bot-1 eds-text-weight--heavy eds-text-bs').text.strip()
-        event_calendar.append(calendar)
         '''
         Get Day, Date, and Time
         '''
         calendar_split = calendar.split(', ')
         # If the event is today or tommorow, the Eventbrite shows like 'Tomorrow at 5:30 PM' or 'Today at 6:00 PM'
         if len(calendar_split) <= 1:
-            # print(calendar_split)
             current_date_time = datetime.datetime.now()
             tomorrow_date_time = current_date_time + datetime.timedelta(days=1)
 
             if 'Today' in calendar_split[0]:
                 day = current_date_time.strftime("%a")
-                event_day.append(day)
                 date = current_date_time.strftime("%b")+ " " + current_date_time.strftime("%d")
-                event_date.append(date)
             else:
                 day = tomorrow_date_time.strftime("%a")
-                event_day.append(day)
                 date = tomorrow_date_time.strftime("%b")+ " " + tomorrow_date_time.strftime("%d")
-                event_date.append(date)
 
             calendar_split_at = calendar_split[0].split('at')
-            event_time.append(calendar_split_at[1])
+            event_time = calendar_split_at[1]
         # If the event is not today or tomorrow, the Eventbrite shows like 'Sat, Apr 18, 3:00 PM'
         else:
-            event_day.append(calendar_split[0])
-            event_date.append(calendar_split[1])
-            event_time.append(calendar_split[2])
+            day = calendar_split[0]
+            date = calendar_split[1]
+            event_time = calendar_split[2]
+
+        yield EventRecord(*event_header, day, date, event_time)
+
+
+def extract_event_records(response):
+    '''Scrape one eventbrite page into JSON friendly lists, for caching the extracted
+    fields only (see CACHE_STORE_EXTRACTED).
+
+    Parameters
+    ----------
+    response: string
+        HTML text of an eventbrite page
+
+    Returns
+    -------
+    list
+        a list of event field lists (see EventRecord.to_list)
+    '''
+    return [an_event.to_list() for an_event in parse_event_page(response)]
+
+
+def get_event_information(a_page_url):
+    '''Get the event information of one eventbrite page through the cache.
+
+    Parameters
+    ----------
+    a_page_url: string
+        The URL for an eventbrite url
+        i.e. (first page)  https://www.eventbrite.com/d/united-states--michigan/all-events/
+        i.e. (second page) https://www.eventbrite.com/d/united-states--michigan/all-events/?page=2
+
+    Returns
+    -------
+    list
+        a list of EventRecord in the page order
+    '''
+    if CACHE_STORE_EXTRACTED:
+        return [EventRecord(*fields) for fields in make_request_with_cache(a_page_url, extract=extract_event_records)]
+    else:
+        return list(parse_event_page(make_request_with_cache(a_page_url)))
 
 
 # Crawling
-def crawl_event_pages(event_brite_state_url, event_crawling_numbers):
-    '''Crawling eventbrite pages and get event information from each page.
+def get_event_page_urls(event_brite_state_url, event_crawling_numbers):
+    '''Get the list of eventbrite page urls to crawl, in page order.
 
     Parameters
     ----------
     event_brite_state_url: string
         i.e. https://www.eventbrite.com/d/united-states--michigan/all-events/
     event_crawling_numbers: int
-        i.e. 52 (state_event_crawling_numbers)
+        i.e. 200 (EVENT_CRAWL_MAX_PAGES)
+
     Returns
     -------
-    none
+    list
+        a list of page urls
+        i.e. [https://www.eventbrite.com/d/united-states--michigan/all-events/,
+        https://www.eventbrite.com/d/united-states--michigan/all-events/?page=2, ...]
     '''
+    page_urls = []
 
     for i in range(event_crawling_numbers):
         if i == 0:
-            get_event_information(event_brite_state_url)
+            page_urls.append(event_brite_state_url)
         else:
             i += 1
             next_page = f"?page={i}"
-            next_url = event_brite_state_url + next_page
-            get_event_information(next_url)
+            page_urls.append(event_brite_state_url + next_page)
 
+    return page_urls
 
-def get_restaurant_information(a_city):
-    '''Obtain restaurant API data from YELP Fusion API.
+
+def get_state_event_url(state_name, event_url_template=EVENTBRITE_STATE_URL):
+    '''Get the eventbrite url of the events of a state.
 
     Parameters
     ----------
-    user_city: string
-        user's city
+    state_name: string
+        name of the state (two character, i.e. MI)
+    event_url_template: string
+        url with a {state_slug} field (i.e. EVENTBRITE_STATE_URL)
 
     Returns
     -------
-    dict
-        a converted API return from YELP Fusion API
+    string
+        i.e. https://www.eventbrite.com/d/united-states--michigan/all-events/
+    '''
+    state_name = state_name.upper()
+    if state_name not in EVENT_STATE_SLUGS:
+        raise ValueError(f"Unknown state: {state_name}")
+    return event_url_template.format(state_slug=EVENT_STATE_SLUGS[state_name])
+
+
+def crawl_event_pages(event_brite_state_url, event_crawling_numbers=EVENT_CRAWL_MAX_PAGES, max_workers=CRAWL_MAX_WORKERS):
+    '''Crawling eventbrite pages and get event information from each page.
+    Pages are fetched and scraped concurrently (bounded by max_workers and the per-host politeness budget),
+    then yielded in page order (the same order as a serial crawl).
+    The last page is detected: the crawl stops after EVENT_CRAWL_EMPTY_PAGES pages in a row without events.
+    A page that could not be fetched (i.e. HTTP 429) is not an empty page: it fails the crawl.
+
+    Parameters
+    ----------
+    event_brite_state_url: string
+        i.e. https://www.eventbrite.com/d/united-states--michigan/all-events/
+    event_crawling_numbers: int
+        the most pages to crawl, i.e. 200 (EVENT_CRAWL_MAX_PAGES)
+    max_workers: int
+        number of pages fetched at the same time (1 -> serial crawl)
+
+    Yields
+    ------
+    EventRecord
+        the events of every page in the page order
+
+    Raises
+    ------
+    requests.RequestException
+        if a page could not be fetched (see make_request)
+    '''
+    page_urls = get_event_page_urls(event_brite_state_url, event_crawling_numbers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Pages fetched ahead of the page being yielded, in page order
+        fetching_pages = deque()
+        next_page_index = 0
+        empty_pages = 0
+
+        while True:
+            while next_page_index < len(page_urls) and len(fetching_pages) < max_workers:
+                fetching_pages.append(executor.submit(get_event_information, page_urls[next_page_index]))
+                next_page_index += 1
+            if not fetching_pages:
+                return
+
+            try:
+                page_events = fetching_pages.popleft().result()
+            except Exception:
+                # The pages fetched ahead are not needed anymore
+                for a_page in fetching_pages:
+                    a_page.cancel()
+                raise
+            if page_events:
+                empty_pages = 0
+                yield from page_events
+            else:
+                empty_pages += 1
+                if empty_pages >= EVENT_CRAWL_EMPTY_PAGES:
+                    # Past the last page
+                    for a_page in fetching_pages:
+                        a_page.cancel()
+                    return
+
+
+# Crawling several states
+def init_crawl_worker(cache_backend, processes, batch_queue, stop_event):
+    '''Prepare a crawl_states worker process: open its own cache connection, keep the queue its
+    event batches are sent through and the stop event, and split the per-host politeness budget
+    between the processes (each process throttles on its own).
+
+    Parameters
+    ----------
+    cache_backend: string
+        backend of the cache (see open_cache)
+    processes: int
+        number of worker processes
+    batch_queue: multiprocessing.Queue
+        bounded queue read by crawl_states
+    stop_event: multiprocessing.Event
+        set by crawl_states when it stops reading the queue
+
+    Returns
+    -------
+    None
+    '''
+    global CACHE_DICT, DEFAULT_HOST_POLITENESS, EVENT_BATCH_QUEUE, EVENT_CRAWL_STOP
+
+    CACHE_DICT = open_cache(cache_backend)
+    EVENT_BATCH_QUEUE = batch_queue
+    EVENT_CRAWL_STOP = stop_event
+    # The process may exit with batches nobody reads anymore (crawl_states stopped early)
+    batch_queue.cancel_join_thread()
+
+    for host, (requests_per_second, max_in_flight) in HOST_POLITENESS.items():
+        HOST_POLITENESS[host] = (requests_per_second / processes, max(1, max_in_flight // processes))
+    requests_per_second, max_in_flight = DEFAULT_HOST_POLITENESS
+    DEFAULT_HOST_POLITENESS = (requests_per_second / processes, max(1, max_in_flight // processes))
+
+
+def crawl_state_events(state_name, event_url_template=EVENTBRITE_STATE_URL, max_pages=None):
+    '''Crawl the events of one state in batches of DB_INSERT_BATCH_SIZE events.
+
+    Parameters
+    ----------
+    state_name: string
+        name of the state (two character, i.e. MI)
+    event_url_template: string
+        url with a {state_slug} field (i.e. EVENTBRITE_STATE_URL)
+    max_pages: int
+        the most pages to crawl (None -> EVENT_CRAWL_MAX_PAGES)
+
+    Yields
+    ------
+    list
+        a batch of EventRecord in the page order
+    '''
+    if max_pages is None:
+        max_pages = EVENT_CRAWL_MAX_PAGES
+    yield from get_batches(crawl_event_pages(get_state_event_url(state_name, event_url_template), max_pages))
+
+
+def put_event_batch(state_name, events_batch):
+    '''Send a batch to crawl_states through EVENT_BATCH_QUEUE, waiting while the queue is full
+    (the crawl does not get ahead of the database inserts) unless the crawl is stopped.
+
+    Parameters
+    ----------
+    state_name: string
+        name of the state (two character, i.e. MI)
+    events_batch: list or None
+        a batch of EventRecord, None at the end of the state
+
+    Returns
+    -------
+    bool
+        False if the crawl was stopped (the batch is not sent)
+    '''
+    while not EVENT_CRAWL_STOP.is_set():
+        try:
+            EVENT_BATCH_QUEUE.put((state_name, events_batch), timeout=EVENT_PIPELINE_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def send_state_events(state_name, event_url_template, max_pages):
+    '''Crawl the events of one state and send the batches to crawl_states through EVENT_BATCH_QUEUE
+    (the task of a crawl_states worker). (state, None) is sent at the end, even if the crawl failed.
+    The crawl ends early, without sending anything more, once EVENT_CRAWL_STOP is set.
+
+    Parameters
+    ----------
+    state_name: string
+        name of the state (two character, i.e. MI)
+    event_url_template: string
+        url with a {state_slug} field (i.e. EVENTBRITE_STATE_URL)
+    max_pages: int
+        the most pages to crawl (passed by crawl_states: the worker has its own module globals)
+
+    Returns
+    -------
+    None
+    '''
+    try:
+        state_events = crawl_event_pages(get_state_event_url(state_name, event_url_template), max_pages)
+        with closing(state_events):
+            running_events = takewhile(lambda event: not EVENT_CRAWL_STOP.is_set(), state_events)
+            for events_batch in get_batches(running_events):
+                if not put_event_batch(state_name, events_batch):
+                    return
+    finally:
+        put_event_batch(state_name, None)
+
+
+def crawl_states(states, event_url_template=EVENTBRITE_STATE_URL, max_processes=EVENT_CRAWL_MAX_PROCESSES, max_pages=None):
+    '''Crawl the events of several states, one state per worker process, so the parsing of the
+    pages of different states runs in parallel. A single state is crawled in this process.
+    The events are streamed in batches while the pages are still crawled; at most
+    EVENT_PIPELINE_QUEUE_SIZE batches wait between the workers and the caller.
+
+    Parameters
+    ----------
+    states: list
+        names of the states (two character, i.e. ['MI', 'OH'])
+    event_url_template: string
+        url with a {state_slug} field (i.e. EVENTBRITE_STATE_URL)
+    max_processes: int
+        number of worker processes
+    max_pages: int
+        the most pages to crawl per state (None -> EVENT_CRAWL_MAX_PAGES)
+
+    Yields
+    ------
+    tuple
+        (state, batch of EventRecord), then (state, None) once every event of the state was yielded
     '''
+    states = [state_name.upper() for state_name in states]
+    if max_pages is None:
+        max_pages = EVENT_CRAWL_MAX_PAGES
+    for state_name in states:
+        # Fail before starting any process
+        get_state_event_url(state_name, event_url_template)
+
+    if len(states) <= 1 or max_processes <= 1:
+        for state_name in states:
+            for events_batch in crawl_state_events(state_name, event_url_template, max_pages):
+                yield state_name, events_batch
+            yield state_name, None
+        return
+
+    processes = min(max_processes, len(states))
+    # "spawn": the workers do not inherit the open sockets and SQLite connections of this process
+    mp_context = multiprocessing.get_context('spawn')
+    batch_queue = mp_context.Queue(maxsize=EVENT_PIPELINE_QUEUE_SIZE)
+    stop_event = mp_context.Event()
+    with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context, initializer=init_crawl_worker,
+                             initargs=(CACHE_BACKEND, processes, batch_queue, stop_event)) as executor:
+        state_crawls = {state_name: executor.submit(send_state_events, state_name, event_url_template, max_pages) for state_name in states}
+
+        finished_states = 0
+        try:
+            while finished_states < len(states):
+                try:
+                    state_name, events_batch = batch_queue.get(timeout=EVENT_PIPELINE_POLL_SECONDS)
+                except queue.Empty:
+                    # A worker that died (BrokenProcessPool) or failed before its end marker never sends it
+                    for state_crawl in state_crawls.values():
+                        if state_crawl.done() and state_crawl.exception() is not None:
+                            raise state_crawl.exception()
+                    continue
+                if events_batch is None:
+                    finished_states += 1
+                    # Raises the error of a failed crawl
+                    state_crawls[state_name].result()
+                yield state_name, events_batch
+        finally:
+            # Stopped early (error or caller): the workers stop crawling and sending; the ones that did
+            # not start are cancelled. The queue is read until they end so none waits on a full queue.
+            stop_event.set()
+            for state_crawl in state_crawls.values():
+                state_crawl.cancel()
+            while not all(state_crawl.done() for state_crawl in state_crawls.values()):
+                try:
+                    batch_queue.get(timeout=EVENT_PIPELINE_POLL_SECONDS)
+                except queue.Empty:
+                    pass
+
+
+class YelpError(Exception):
+    '''Error response of YELP Fusion API (i.e. a rate limit or an expired key), raised while
+    the restaurants of a city are fetched.
 
-    offset_num = get_yelp_offset_number()
+    Parameters
+    ----------
+    a_city: string
+        name of the city (i.e. detroit, ann arbor)
+    error: dict
+        the 'error' of the response
+        i.e. {'code': 'TOO_MANY_REQUESTS_PER_SECOND', 'description': '...'}
+    '''
+    def __init__(self, a_city, error):
+        self.city = a_city
+        self.error = error
+        super().__init__(f"Yelp error for {a_city}: {error}")
+
+
+def iter_restaurant_information(a_city, state='MI', max_workers=YELP_MAX_WORKERS):
+    '''Obtain restaurant API data from YELP Fusion API, one business at a time while the next pages download.
+    The first page tells how many businesses the city has (total), so only the offsets
+    needed are requested, concurrently, and collecting stops at the first short page.
+
+    Parameters
+    ----------
+    a_city: string
+        user's city
+    state: string
+        name of the state (two character), searched with the city (i.e. 'ann arbor, MI')
+    max_workers: int
+        number of offset requests sent at the same time
 
-    total_result = []
+    Yields
+    ------
+    dict
+        a business dictionary from YELP Fusion API, in the offset order
 
+    Raises
+    ------
+    YelpError
+        if YELP Fusion API returns an error (other than YELP_NO_BUSINESSES_ERRORS)
+    '''
     headers = {'Authorization': f'Bearer {YELP_API_KEY}'}
 
-    for an_offset_num in offset_num:
+    def fetch_offset(an_offset_num):
         params = {
-            'location': a_city,
+            'location': f"{a_city}, {state.upper()}",
             'offset': an_offset_num,
-            'limit': 50,
+            'limit': YELP_PAGE_LIMIT,
         }
-        response = make_request_with_cache(YELP_API_URL, params=params, headers=headers)
-        # Because sometimes there are not 1000 restaurants in a city, the response may retrun 'error' key
-        # instead of 'businesses' key. To prevent this, check if there is a 'business' key to exclude to append
-        # error data
-        if 'businesses' in response.keys():
-            result_business = response['businesses']
-            for item in result_business:
-                total_result.append(item)
+        if CACHE_STORE_EXTRACTED:
+            return make_request_with_cache(YELP_API_URL, params=params, headers=headers, extract=extract_yelp_businesses)
+        else:
+            return make_request_with_cache(YELP_API_URL, params=params, headers=headers)
+
+    # An unknown location has no restaurants. Any other error (i.e. a rate limit) is raised, so the city
+    # is not recorded as loaded with the restaurants fetched so far (see load_restaurants).
+    first_response = fetch_offset(0)
+    if 'businesses' not in first_response.keys():
+        if first_response.get('error', {}).get('code') in YELP_NO_BUSINESSES_ERRORS:
+            return
+        raise YelpError(a_city, first_response.get('error'))
 
-    return total_result
+    yield from first_response['businesses']
+    if len(first_response['businesses']) < YELP_PAGE_LIMIT:
+        return
 
+    offset_num = get_yelp_offset_number(first_response.get('total', YELP_MAX_RESULTS))[1:]
+    if not offset_num:
+        return
 
-def get_yelp_offset_number():
-    '''Get a list of offset numbers increased by 50.
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(offset_num)))) as executor:
+        # executor.map keeps the offset order
+        for response in executor.map(fetch_offset, offset_num):
+            if 'businesses' not in response.keys():
+                raise YelpError(a_city, response.get('error'))
+            yield from response['businesses']
+            if len(response['businesses']) < YELP_PAGE_LIMIT:
+                break
+
+
+def extract_yelp_businesses(response):
+    '''Keep only the fields of a YELP Fusion API search response that load_restaurants uses.
+
+    Parameters
+    ----------
+    response: dict
+        a converted API return from YELP Fusion API
+
+    Returns
+    -------
+    dict
+        the same structure with only 'total', 'error', and the used business fields
+        i.e. {'total': 30, 'businesses': [{'id': ..., 'name': ..., 'price': ..., 'rating': ...,
+        'review_count': ..., 'display_phone': ..., 'location': {'city': ..., 'state': ...}}]}
+    '''
+    business_fields = ['id', 'name', 'price', 'rating', 'review_count', 'display_phone']
+
+    extracted = {}
+    for key in ['total', 'error']:
+        if key in response.keys():
+            extracted[key] = response[key]
+
+    if 'businesses' in response.keys():
+        extracted['businesses'] = []
+        for business in response['businesses']:
+            extracted_business = {}
+            for field in business_fields:
+                if field in business.keys():
+                    extracted_business[field] = business[field]
+            extracted_business['location'] = {
+                'city': business['location']['city'],
+                'state': business['location']['state'],
+            }
+            extracted['businesses'].append(extracted_business)
+
+    return extracted
+
+
+def get_yelp_offset_number(total=YELP_MAX_RESULTS):
+    '''Get a list of offset numbers increased by 50 that cover the total number of businesses.
     i.e. 0, 50, 100, 150, 200, ...
 
     Parameters
     ----------
-    None
+    total: int
+        total number of businesses reported by YELP Fusion API
+        (capped at 1000, the maximum YELP returns for a search)
 
     Returns
     -------
@@ -238,91 +864,596 @@ def get_yelp_offset_number():
     offset_num =[]
 
     count = 0
-    while count <= 950:
+    while count < min(total, YELP_MAX_RESULTS):
         offset_num.append(count)
-        count += 50
+        count += YELP_PAGE_LIMIT
 
     return offset_num
 
 
-def get_cities_name(state_name):
-    '''Get a cities list in a state.
+class CityIndex:
+    '''Index of the cities of uscities.csv per state, for O(1) membership checks
+    and prefix lookups (binary search in the sorted names) without reading the CSV file.
+    Prefix matches can be ranked by the "ranking" and "population" columns for autocomplete.
+
+    Parameters
+    ----------
+    None
+    '''
+    def __init__(self):
+        # state -> normalized city names in the CSV order (i.e. {'MI': ['detroit', 'grand rapids', ...]})
+        self.cities_by_state = {}
+        # state -> set of normalized city names
+        self.city_sets_by_state = {}
+        # state -> sorted unique normalized city names
+        self.sorted_cities_by_state = {}
+        # (state, normalized city name) -> (ranking, -population, display name), the best entry of a name
+        self.city_ranks = {}
+        # (state, short prefix) -> the CITY_SUGGESTIONS_LIMIT best ranks of the prefix
+        self.top_ranks_by_prefix = {}
+
+    @classmethod
+    def from_csv(cls, filename=US_CITIES):
+        '''Build the index from the uscities csv file.
+
+        Parameters
+        ----------
+        filename: string
+            path of the uscities csv file
+
+        Returns
+        -------
+        CityIndex
+            the built index
+        '''
+        city_index = cls()
+
+        # Headers: "city","city_ascii","state_id","state_name","county_fips","county_name","county_fips_all","county_name_all","lat","lng",
+        # "population","density","source","military","incorporated","timezone","ranking","zips","id"
+        # i.e. Records: "South Creek","South Creek","WA","Washington","53053","Pierce","53053","Pierce","46.9994","-122.3921",
+        # "2500","125","polygon","FALSE","TRUE","America/Los_Angeles","3","98580 98387 98338","1840042075"
+        with open(filename, 'r') as file_contents:
+            file_reader = csv.reader(file_contents)
+
+            # Skip header row
+            next(file_reader)
+
+            for city_data in file_reader:
+                city_index.add_city(city_data[2], city_data[0], population=city_data[10], ranking=city_data[16])
+
+        city_index.build()
+        return city_index
+
+    def add_city(self, state_name, city_name, population=0, ranking=None):
+        '''Add a city of the CSV file (call build once every city was added).
+
+        Parameters
+        ----------
+        state_name: string
+            name of the state (two character, i.e. MI)
+        city_name: string
+            name of the city (i.e. Ann Arbor)
+        population: int or string
+            population of the city ("population" column)
+        ranking: int or string
+            ranking of the city, 1 is the most important ("ranking" column)
+
+        Returns
+        -------
+        None
+        '''
+        state_name = state_name.upper()
+        normalized_city = normalize_location_name(city_name)
+        self.cities_by_state.setdefault(state_name, []).append(normalized_city)
+
+        try:
+            population = int(float(population))
+        except (TypeError, ValueError):
+            population = 0
+        try:
+            ranking = int(ranking)
+        except (TypeError, ValueError):
+            ranking = CITY_DEFAULT_RANKING
+
+        rank = (ranking, -population, city_name.strip())
+        key = (state_name, normalized_city)
+        if key not in self.city_ranks or rank < self.city_ranks[key]:
+            self.city_ranks[key] = rank
+
+    def build(self):
+        '''Build the sets and the sorted lists once every city was added.'''
+        for state_name, cities_list in self.cities_by_state.items():
+            self.city_sets_by_state[state_name] = set(cities_list)
+            self.sorted_cities_by_state[state_name] = sorted(self.city_sets_by_state[state_name])
+
+        ranks_by_prefix = {}
+        for (state_name, city_name), rank in self.city_ranks.items():
+            for length in range(1, min(len(city_name), CITY_PREFIX_CACHE_LENGTH) + 1):
+                ranks_by_prefix.setdefault((state_name, city_name[:length]), []).append(rank)
+        for key, ranks in ranks_by_prefix.items():
+            self.top_ranks_by_prefix[key] = heapq.nsmallest(CITY_SUGGESTIONS_LIMIT, ranks)
+
+    def get_cities(self, state_name, by_population=False):
+        '''Get the normalized city names of a state in the CSV order,
+        or each name once from the most to the least populated (by_population=True).'''
+        state_name = state_name.upper()
+        if by_population:
+            return sorted(self.city_sets_by_state.get(state_name, ()),
+                          key=lambda city_name: (self.city_ranks[(state_name, city_name)][1], city_name))
+        return list(self.cities_by_state.get(state_name, []))
+
+    def contains(self, state_name, city_name):
+        '''Check if a city is in a state (case and whitespace insensitive).'''
+        return normalize_location_name(city_name) in self.city_sets_by_state.get(state_name.upper(), ())
+
+    def find_prefix(self, state_name, prefix, limit=None):
+        '''Get the city names of a state starting with a prefix, in alphabetical order.
+
+        Parameters
+        ----------
+        state_name: string
+            name of the state (two character, i.e. MI)
+        prefix: string
+            beginning of the city name (i.e. 'ann a')
+        limit: int
+            maximum number of names (None -> all)
+
+        Returns
+        -------
+        list
+            normalized city names (i.e. ['ann arbor'])
+        '''
+        sorted_cities = self.sorted_cities_by_state.get(state_name.upper(), [])
+        prefix = normalize_location_name(prefix)
+
+        matches = []
+        i = bisect_left(sorted_cities, prefix)
+        while i < len(sorted_cities) and sorted_cities[i].startswith(prefix):
+            if limit is not None and len(matches) >= limit:
+                break
+            matches.append(sorted_cities[i])
+            i += 1
+        return matches
+
+    def suggest(self, state_name, prefix, limit=CITY_SUGGESTIONS_LIMIT):
+        '''Get the best cities of a state starting with a prefix, for autocomplete.
+        Cities are ranked by "ranking" (1 first), then by population.
+
+        Parameters
+        ----------
+        state_name: string
+            name of the state (two character, i.e. MI)
+        prefix: string
+            beginning of the city name typed by the user (i.e. 'ann')
+        limit: int
+            maximum number of suggestions
+
+        Returns
+        -------
+        list
+            display city names (i.e. ['Ann Arbor'])
+        '''
+        state_name = state_name.upper()
+        prefix = normalize_location_name(prefix)
+        if not prefix:
+            return []
+
+        if len(prefix) <= CITY_PREFIX_CACHE_LENGTH and limit <= CITY_SUGGESTIONS_LIMIT:
+            best_ranks = self.top_ranks_by_prefix.get((state_name, prefix), [])[:limit]
+        else:
+            matches = self.find_prefix(state_name, prefix)
+            best_ranks = heapq.nsmallest(limit, (self.city_ranks[(state_name, city)] for city in matches))
+        return [rank[2] for rank in best_ranks]
+
+
+def get_city_index():
+    '''Get the city index, building it from US_CITIES the first time.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    CityIndex
+        the shared city index
+    '''
+    global CITY_INDEX
+    with CITY_INDEX_LOCK:
+        if CITY_INDEX is None:
+            CITY_INDEX = CityIndex.from_csv(US_CITIES)
+        return CITY_INDEX
+
+
+def get_cities_name(state_name, by_population=False):
+    '''Get a cities list in a state (from the city index, the CSV file is only read once).
 
     Parameters
     ----------
     state_name: string
         name of the state (two character)
         i.e. MI
+    by_population: bool
+        True -> each city once, the most populated first (i.e. ['detroit', 'grand rapids', ...])
 
     Returns
     -------
     list
         a list of lower cased cities names in the state
     '''
-    cities_list = []
+    return get_city_index().get_cities(state_name, by_population=by_population)
 
-    file_contents = open(US_CITIES,'r')
-    file_reader = csv.reader(file_contents)
 
-    # Headers: "city","city_ascii","state_id","state_name","county_fips","county_name","county_fips_all","county_name_all","lat","lng",
-    # "population","density","source","military","incorporated","timezone","ranking","zips","id"
-    # i.e. Records: "South Creek","South Creek","WA","Washington","53053","Pierce","53053","Pierce","46.9994","-122.3921",
-    # "2500","125","polygon","FALSE","TRUE","America/Los_Angeles","3","98580 98387 98338","1840042075"
+'''
+Part 2: Caching
+'''
+class SqliteCache:
+    '''Request cache stored in a SQLite file, one row per request key.
+    It behaves like a dictionary, but each write only touches its own row and
+    each read only loads the requested entry, so the whole cache never has to be
+    loaded into memory or written back to disk.
 
-    # Skip header row
-    next(file_contents)
+    Entries expire per source (ttl_seconds) and the least recently used entries are
+    evicted once the cached values exceed max_bytes. The size is read from the file before
+    evicting, since the crawl worker and app processes all write to it. Hits, misses,
+    expirations and evictions of this process are counted in stats.
 
-    for city_data in file_reader:
-        if city_data[2] == state_name:
-            # Get Lowered City Name (i.e. detroit, ann arbor)
-            cities_list.append(city_data[0].lower())
+    The connection is closed when the process exits (pending access times are written).
 
-    return cities_list
+    Values are stored as zlib compressed JSON and only decompressed when they are read
+    (entries written before compression was added are plain JSON text).
 
+    Reads do not write: the access times of the hits are kept in memory and written
+    CACHE_ACCESS_BATCH_SIZE at a time, or with the next write or eviction.
 
-'''
-Part 2: Caching
-'''
-def open_cache():
-    ''' Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary.
+    Parameters
+    ----------
+    db_filename: string
+        path of the SQLite cache file
+    ttl_seconds: dict
+        source: seconds pairs (i.e. {'eventbrite': 10800}), see get_cache_source
+    max_bytes: int
+        maximum total size of the (compressed) cached values
+    compression_level: int
+        zlib compression level (0 -> stored uncompressed)
+    '''
+    def __init__(self, db_filename, ttl_seconds=CACHE_TTL_SECONDS, max_bytes=CACHE_MAX_BYTES,
+                 compression_level=CACHE_COMPRESSION_LEVEL):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.compression_level = compression_level
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+        # Key -> access time of the hits not written yet
+        self.access_times = {}
+        self.lock = threading.Lock()
+        # The cache is shared by the crawling threads
+        # and by the crawl_states worker processes (they wait for each other's writes)
+        self.conn = sqlite3.connect(db_filename, timeout=DB_BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        # WAL: the reads of a process are not blocked by the writes of the others, and a commit
+        # does not sync the disk (synchronous NORMAL, a lost cache entry is fetched again)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS "CacheEntries" (
+                "Key" TEXT PRIMARY KEY,
+                "Value" TEXT NOT NULL
+            )
+        ''')
+        # Columns added for the expiry and eviction policies (older cache files do not have them)
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info("CacheEntries")')]
+        if 'Source' not in columns:
+            now = time.time()
+            self.conn.execute('ALTER TABLE CacheEntries ADD COLUMN "Source" TEXT')
+            self.conn.execute('ALTER TABLE CacheEntries ADD COLUMN "CreatedAt" REAL NOT NULL DEFAULT 0')
+            self.conn.execute('ALTER TABLE CacheEntries ADD COLUMN "AccessedAt" REAL NOT NULL DEFAULT 0')
+            self.conn.execute('ALTER TABLE CacheEntries ADD COLUMN "Size" INTEGER NOT NULL DEFAULT 0')
+            self.conn.create_function('cache_source', 1, get_cache_source)
+            self.conn.execute(
+                'UPDATE CacheEntries SET Source = cache_source(Key), CreatedAt = ?, AccessedAt = ?, Size = LENGTH(Value)',
+                [now, now]
+            )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "CacheEntriesAccessedAt" ON "CacheEntries" ("AccessedAt")')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "CacheEntriesSourceCreatedAt" ON "CacheEntries" ("Source", "CreatedAt")')
+        self.conn.commit()
+        self.closed = False
+        atexit.register(self.close)
+
+    def get_ttl(self, source):
+        return self.ttl_seconds.get(source, DEFAULT_CACHE_TTL_SECONDS)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT Value, Source, CreatedAt FROM CacheEntries WHERE Key = ?', [key]).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return default
+            value, source, created_at = row
+            ttl = self.get_ttl(source)
+            if ttl is not None and now - created_at > ttl:
+                self.conn.execute('DELETE FROM CacheEntries WHERE Key = ?', [key])
+                self.conn.commit()
+                self.access_times.pop(key, None)
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return default
+            # Least recently used bookkeeping
+            self.access_times[key] = now
+            if len(self.access_times) >= CACHE_ACCESS_BATCH_SIZE:
+                self.write_access_times()
+                self.conn.commit()
+            self.stats['hits'] += 1
+        return decode_cache_value(value)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __contains__(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM CacheEntries WHERE Key = ?', [key]).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM CacheEntries').fetchone()[0]
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT Key FROM CacheEntries')]
+
+    def update(self, cache_dict):
+        '''Write several entries in a single transaction, then evict the least
+        recently used entries if the cache is over max_bytes.
+
+        Parameters
+        ----------
+        cache_dict: dict
+            request key: result pairs
+
+        Returns
+        -------
+        None
+        '''
+        now = time.time()
+        with self.lock:
+            self.write_access_times()
+            for key, value in cache_dict.items():
+                encoded_value = encode_cache_value(value, self.compression_level)
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO CacheEntries VALUES (?, ?, ?, ?, ?, ?)',
+                    [key, encoded_value, get_cache_source(key), now, now, len(encoded_value)]
+                )
+            self.evict()
+            self.conn.commit()
+
+    def write_access_times(self):
+        '''Write the access times of the hits kept in memory (one executemany).
+        The caller holds the lock and commits.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        if self.access_times:
+            self.conn.executemany('UPDATE CacheEntries SET AccessedAt = ? WHERE Key = ?',
+                                  [(accessed_at, key) for key, accessed_at in self.access_times.items()])
+            self.access_times.clear()
+
+    def get_total_bytes(self):
+        '''Get the size of the cached values of every process from the file.
+        The caller holds the lock.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        int
+            total size of the (compressed) cached values
+        '''
+        return self.conn.execute('SELECT COALESCE(SUM(Size), 0) FROM CacheEntries').fetchone()[0]
 
-    if the cache file doesn't exist, creates a new cache dictionary
+    def evict(self):
+        '''Delete the least recently used entries until the cache fits in max_bytes.
+        The caller holds the lock, in a write transaction (the size cannot change in another process meanwhile).
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        total_bytes = self.get_total_bytes()
+        while total_bytes > self.max_bytes:
+            rows = self.conn.execute('SELECT Key, Size FROM CacheEntries ORDER BY AccessedAt LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total_bytes <= self.max_bytes:
+                    break
+                self.conn.execute('DELETE FROM CacheEntries WHERE Key = ?', [key])
+                total_bytes -= size
+                self.stats['evictions'] += 1
+
+    def purge_expired(self):
+        '''Delete every expired entry.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        int
+            number of deleted entries
+        '''
+        now = time.time()
+        deleted = 0
+        with self.lock:
+            sources = [row[0] for row in self.conn.execute('SELECT DISTINCT Source FROM CacheEntries')]
+            for source in sources:
+                ttl = self.get_ttl(source)
+                if ttl is None:
+                    continue
+                deleted += self.conn.execute(
+                    'DELETE FROM CacheEntries WHERE Source IS ? AND CreatedAt < ?', [source, now - ttl]
+                ).rowcount
+            self.conn.commit()
+            self.stats['expired'] += deleted
+        return deleted
+
+    def get_stats(self):
+        '''Get the cache counters and current size.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict
+            i.e. {'hits': 52, 'misses': 20, 'expired': 0, 'evictions': 0, 'entries': 72, 'bytes': 3012345}
+        '''
+        stats = dict(self.stats)
+        stats['entries'] = len(self)
+        with self.lock:
+            stats['bytes'] = self.get_total_bytes()
+        return stats
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.write_access_times()
+            self.conn.commit()
+            self.conn.close()
+            self.closed = True
+
+
+def encode_cache_value(value, compression_level=CACHE_COMPRESSION_LEVEL):
+    '''Serialize a cached value to JSON and compress it.
 
     Parameters
     ----------
-    None
+    value: dict, list or string
+        a request result
+    compression_level: int
+        zlib compression level (0 -> plain JSON text)
+
+    Returns
+    -------
+    bytes or string
+        compressed JSON (bytes), or plain JSON text if compression_level is 0
+    '''
+    dumped_json = json.dumps(value)
+    if compression_level == 0:
+        return dumped_json
+    return zlib.compress(dumped_json.encode('utf-8'), compression_level)
+
+
+def decode_cache_value(encoded_value):
+    '''Decompress and load a cached value made by encode_cache_value.
+
+    Parameters
+    ----------
+    encoded_value: bytes or string
+        compressed JSON (bytes) or plain JSON text
+
+    Returns
+    -------
+    dict, list or string
+        the request result
+    '''
+    if isinstance(encoded_value, bytes):
+        encoded_value = zlib.decompress(encoded_value).decode('utf-8')
+    return json.loads(encoded_value)
+
+
+def get_cache_source(request_key):
+    '''Get the source of a cached request, used to pick its expiry policy.
+
+    Parameters
+    ----------
+    request_key: string
+        a key made by construct_unique_key
+
+    Returns
+    -------
+    string
+        'yelp', 'eventbrite', or the host name for other sources
+    '''
+    host = urlsplit(request_key).netloc
+    if host.endswith('yelp.com'):
+        return 'yelp'
+    elif host.endswith('eventbrite.com'):
+        return 'eventbrite'
+    else:
+        return host
+
+
+def open_cache(backend=CACHE_BACKEND):
+    ''' Opens the cache backend.
+    For the "sqlite" backend, the legacy cache.json file is migrated into the SQLite
+    cache the first time (see migrate_json_cache).
+
+    Parameters
+    ----------
+    backend: string
+        "sqlite" (default) or "memory"
 
     Returns
     -------
     The opened cache
     '''
-    try:
-        cache_file = open(CACHE_FILENAME, 'r')
-        cache_contents = cache_file.read()
-        cache_dict = json.loads(cache_contents)
-        cache_file.close()
-    except:
-        cache_dict = {}
-    return cache_dict
+    if backend == "memory":
+        return {}
 
+    cache = SqliteCache(CACHE_DB_FILENAME)
+    migrate_json_cache(cache)
+    cache.purge_expired()
+    return cache
 
-def save_cache(cache_dict):
-    ''' saves the current state of the cache to disk
+
+def migrate_json_cache(cache, json_filename=CACHE_FILENAME):
+    '''Copy every entry of the legacy JSON cache file into the cache, then rename the
+    file (i.e. cache.json -> cache.json.migrated) so the migration only runs once.
 
     Parameters
     ----------
-    cache_dict: dict
-        The dictionary to save
+    cache: SqliteCache
+        the cache to migrate into
+    json_filename: string
+        path of the legacy JSON cache file
 
     Returns
     -------
-    None
+    int
+        number of migrated entries
     '''
-    dumped_json_cache = json.dumps(cache_dict)
-    fw = open(CACHE_FILENAME,"w")
-    fw.write(dumped_json_cache)
-    fw.close()
+    try:
+        cache_file = open(json_filename, 'r')
+        cache_dict = json.loads(cache_file.read())
+        cache_file.close()
+    except (OSError, ValueError):
+        return 0
+
+    cache.update(cache_dict)
+    os.replace(json_filename, json_filename + '.migrated')
+    print(f"Migrated {len(cache_dict)} cache entries from {json_filename}")
+    return len(cache_dict)
 
 
 def construct_unique_key(baseurl, params=None):
@@ -355,6 +1486,60 @@ def construct_unique_key(baseurl, params=None):
         return unique_key
 
 
+class HostThrottle:
+    '''Politeness budget for one host: a minimum interval between request starts
+    and a maximum number of requests in flight. Used as a context manager around a request.
+
+    Parameters
+    ----------
+    requests_per_second: float
+        maximum number of requests started per second
+    max_in_flight: int
+        maximum number of requests running at the same time
+    '''
+    def __init__(self, requests_per_second, max_in_flight):
+        self.interval = 1.0 / requests_per_second
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def __enter__(self):
+        self.in_flight.acquire()
+        # Reserve the next start slot, then wait for it outside of the lock
+        with self.lock:
+            now = time.monotonic()
+            start_at = max(now, self.next_slot)
+            self.next_slot = start_at + self.interval
+        if start_at > now:
+            time.sleep(start_at - now)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.in_flight.release()
+        return False
+
+
+def get_host_throttle(baseurl):
+    '''Get (or create) the HostThrottle for the host of the url.
+
+    Parameters
+    ----------
+    baseurl: string
+        The URL for the API endpoint or the website
+
+    Returns
+    -------
+    HostThrottle
+        the shared throttle of the host
+    '''
+    host = urlsplit(baseurl).netloc
+    with HOST_THROTTLES_LOCK:
+        if host not in HOST_THROTTLES:
+            requests_per_second, max_in_flight = HOST_POLITENESS.get(host, DEFAULT_HOST_POLITENESS)
+            HOST_THROTTLES[host] = HostThrottle(requests_per_second, max_in_flight)
+        return HOST_THROTTLES[host]
+
+
 def make_request(baseurl, params=None, headers=None):
     '''Make a request to the Web API using the baseurl and params
 
@@ -377,18 +1562,28 @@ def make_request(baseurl, params=None, headers=None):
     or
     string
         the results of the query as a HTML text loaded on the website
+
+    Raises
+    ------
+    requests.HTTPError
+        if the response is not a success (i.e. 429 or 503), except the JSON errors of YELP Fusion API
+        (they are returned, see iter_restaurant_information)
     '''
-    response = requests.get(baseurl, params=params, headers=headers)
+    # For beign a good citizen when scraping and crawling (see HOST_POLITENESS)
+    with get_host_throttle(baseurl):
+        response = HTTP_SESSION.get(baseurl, params=params, headers=headers)
 
     if baseurl == YELP_API_URL:
+        if not response.ok and not response.headers.get('Content-Type', '').startswith('application/json'):
+            response.raise_for_status()
         return response.json()
     else:
-        # For beign a good citizen when scraping and crawling
-        time.sleep(1)
+        # An error page is not a page without events: the crawl fails (and is not cached) instead of stopping early
+        response.raise_for_status()
         return response.text
 
 
-def make_request_with_cache(baseurl, params=None, headers=None):
+def make_request_with_cache(baseurl, params=None, headers=None, extract=None):
     '''Check the cache for a saved result for this baseurl+params+headers
     combo. If the result is found, return it. Otherwise send a new
     request, save it, then return it.
@@ -405,28 +1600,44 @@ def make_request_with_cache(baseurl, params=None, headers=None):
         A dictionary of headers
         i.e. headers = {'Authorization': f'Bearer {YELP_API_KEY}'}
 
+    extract: function
+        If given, it is applied to the result before it is saved, so only the extracted
+        fields are cached (i.e. parse_event_page). It is part of the cache key.
+
     Returns
     -------
     string
         the results of the query as a Python object loaded from JSON
     '''
     request_key = construct_unique_key(baseurl, params)
-    if request_key in CACHE_DICT.keys():
+    if extract is not None:
+        request_key += f"_{extract.__name__}"
+    result = CACHE_DICT.get(request_key)
+    # An error response cached by an older version is asked again
+    if result is not None and not (isinstance(result, dict) and 'error' in result):
         print(f"Using cache! {request_key}")
-        return CACHE_DICT[request_key]
+        return result
     else:
         print(f"Fetching {request_key}")
-        CACHE_DICT[request_key] = make_request(baseurl, params, headers)
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[request_key]
+        result = make_request(baseurl, params, headers)
+        if extract is not None:
+            result = extract(result)
+        # Error responses (i.e. a Yelp rate limit) are not cached, the next call asks again
+        if isinstance(result, dict) and 'error' in result:
+            return result
+        # Only this entry is written (see SqliteCache)
+        CACHE_DICT[request_key] = result
+        return result
 
 
 '''
 Part 4 Database Access and Storage
 '''
-# Create Tables
-def create_db():
-    '''Create three tables (Locations, Events, and Restaurnts) in the database.
+# Database Connections
+def open_db_connection():
+    '''Open a connection to the database with the settings shared by every connection:
+    WAL journal (readers do not block the writer and see the last committed data),
+    synchronous NORMAL (safe with WAL, fewer disk syncs), a bigger page cache and a busy timeout.
 
     Parameters
     ----------
@@ -434,38 +1645,146 @@ def create_db():
 
     Returns
     -------
-    None
+    sqlite3.Connection
+        the opened connection (it can be handed to another thread, one thread at a time),
+        read-only if DB_READ_ONLY
     '''
-    # Create or connect database
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    if DB_READ_ONLY:
+        # A snapshot is never written, so its journal mode is left as it is
+        conn = sqlite3.connect(f"{Path(DB_NAME).resolve().as_uri()}?mode=ro", uri=True,
+                               timeout=DB_BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+        return conn
+
+    conn = sqlite3.connect(DB_NAME, timeout=DB_BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+    return conn
+
+
+def get_db_connection():
+    '''Get a read connection for the current Flask request or thread.
+    In a Flask request, a connection is taken from DB_READ_POOL and given back when the
+    app context ends (see release_db_connection). Other threads keep their own connection.
+    Writes go through db_writer instead.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    sqlite3.Connection
+        the read connection
+    '''
+    if has_app_context():
+        if 'db' not in g:
+            try:
+                g.db = DB_READ_POOL.get_nowait()
+            except queue.Empty:
+                g.db = open_db_connection()
+        return g.db
+
+    conn = getattr(DB_CONNECTIONS, 'conn', None)
+    if conn is None:
+        conn = open_db_connection()
+        DB_CONNECTIONS.conn = conn
+    return conn
+
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    '''Give the read connection of the request back to DB_READ_POOL.
+
+    Parameters
+    ----------
+    exception: Exception
+        the exception of the request, if any
+
+    Returns
+    -------
+    None
+    '''
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    if DB_READ_POOL.qsize() < DB_READ_POOL_SIZE:
+        DB_READ_POOL.put(conn)
+    else:
+        conn.close()
+
 
-    drop_locations_sql = 'DROP TABLE IF EXISTS "Locations"'
-    drop_events_sql = 'DROP TABLE IF EXISTS "Events"'
-    drop_restaurants_sql = 'DROP TABLE IF EXISTS "Restaurants"'
+@contextmanager
+def db_writer():
+    '''Write to the database in one transaction through the single writer connection.
+    The transaction is committed at the end of the with block (rolled back on an error).
+    Writers of this process wait for each other here instead of failing with "database is locked".
 
-    create_locations_sql = '''
-        CREATE TABLE IF NOT EXISTS "Locations" (
+    Parameters
+    ----------
+    None
+
+    Yields
+    ------
+    sqlite3.Cursor
+        a cursor of the writer connection
+
+    i.e.
+        with db_writer() as cur:
+            cur.execute(...)
+    '''
+    global DB_WRITER
+    with DB_WRITE_LOCK:
+        if DB_WRITER is None:
+            DB_WRITER = open_db_connection()
+        cur = DB_WRITER.cursor()
+        try:
+            yield cur
+            DB_WRITER.commit()
+        except BaseException:
+            DB_WRITER.rollback()
+            raise
+        finally:
+            cur.close()
+
+
+# Database Schema
+# Each migration moves the schema one version up (the version is stored in PRAGMA user_version).
+# A migration is a SQL script, or a function taking a cursor when it needs Python.
+# Add new migrations at the end; never edit one that was already released.
+SCHEMA_MIGRATIONS = [
+    # Version 1: the tables used to be dropped and rebuilt on every launch, so the
+    # unversioned tables are simply replaced.
+    '''
+        DROP TABLE IF EXISTS "Locations";
+        DROP TABLE IF EXISTS "Events";
+        DROP TABLE IF EXISTS "Restaurants";
+
+        CREATE TABLE "Locations" (
             "Id" INTEGER PRIMARY KEY AUTOINCREMENT,
             "City" TEXT NOT NULL,
             "State" TEXT NOT NULL,
             "Country" TEXT
-        )
-    '''
+        );
+        -- load_events and load_restaurants look up Locations by (City, State)
+        CREATE INDEX "LocationsCityState" ON "Locations" ("City", "State");
 
-    create_events_sql = '''
-        CREATE TABLE IF NOT EXISTS "Events"(
+        CREATE TABLE "Events"(
             "EventId" INTEGER PRIMARY KEY AUTOINCREMENT,
             "EventName" TEXT NOT NULL,
             "Day" TEXT,
             "Date" TEXT,
             "Time" TEXT,
-            "LocationId" INTEGER
-        )
-    '''
+            "LocationId" INTEGER,
+            -- Identity of a scraped event for upserts (see EventRecord.get_key)
+            "EventKey" TEXT NOT NULL UNIQUE
+        );
+        CREATE INDEX "EventsLocationId" ON "Events" ("LocationId");
 
-    create_restaurants_sql = '''
-        CREATE TABLE IF NOT EXISTS "Restaurants"(
+        CREATE TABLE "Restaurants"(
             "RestaurantId" TEXT PRIMARY KEY,
             "RestaurantName" TEXT NOT NULL,
             "Price" TEXT,
@@ -473,117 +1792,299 @@ def create_db():
             "TotalReviews" INTEGER,
             "PhoneNumber" TEXT,
             "LocationId" INTEGER
-        )
+        );
+        CREATE INDEX "RestaurantsLocationId" ON "Restaurants" ("LocationId");
+    ''',
+    # Version 2: what was loaded for each city and when (see get_load_status)
     '''
+        CREATE TABLE "LoadStatus" (
+            "City" TEXT NOT NULL,
+            "State" TEXT NOT NULL,
+            "Source" TEXT NOT NULL,
+            "FetchedAt" REAL NOT NULL,
+            "RowCount" INTEGER NOT NULL,
+            PRIMARY KEY ("City", "State", "Source")
+        );
+
+        INSERT INTO LoadStatus
+        SELECT LOWER(TRIM(Locations.City)), Locations.State, 'yelp', CAST(strftime('%s', 'now') AS REAL), COUNT(*)
+        FROM Restaurants
+        JOIN Locations
+        ON Restaurants.LocationId = Locations.Id
+        GROUP BY Locations.Id;
+    ''',
+    # Version 3: per-city aggregates for the results page (see refresh_city_stats)
+    lambda cur: migrate_city_stats(cur),
+]
+
+
+# Create Tables
+def create_db():
+    '''Create the tables (Locations, Events, and Restaurnts) in the database, or bring an
+    existing database up to date by running the SCHEMA_MIGRATIONS it has not run yet.
+    Existing data is kept.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    int
+        the schema version of the database
+    '''
+    # Create or connect database
+    conn = open_db_connection()
+    cur = conn.cursor()
+
+    schema_version = cur.execute('PRAGMA user_version').fetchone()[0]
+
+    for new_version in range(schema_version + 1, len(SCHEMA_MIGRATIONS) + 1):
+        print(f"Migrating the database to schema version {new_version}")
+        migration = SCHEMA_MIGRATIONS[new_version - 1]
+        # The migration and its version number are committed together
+        if callable(migration):
+            cur.execute('BEGIN')
+            migration(cur)
+            cur.execute(f'PRAGMA user_version = {new_version}')
+            conn.commit()
+        else:
+            cur.executescript(f'''
+                BEGIN;
+                {migration}
+                PRAGMA user_version = {new_version};
+                COMMIT;
+            ''')
+        schema_version = new_version
 
-    cur.execute(drop_locations_sql)
-    cur.execute(drop_events_sql)
-    cur.execute(drop_restaurants_sql)
-    cur.execute(create_locations_sql)
-    cur.execute(create_events_sql)
-    cur.execute(create_restaurants_sql)
-    conn.commit()
     conn.close()
 
+    return schema_version
+
 
 # Part 4-b-i Load Cities Data
-def load_locations():
+def load_locations(force=False):
     '''Insert data into the Dabatabe.
     Get cities data from uscities.csv, process data, and put the processed data into the Database.
+    All rows are inserted with executemany in a single transaction.
+    The cities are only loaded once (the Locations table is kept between launches).
 
     Parameters
     ----------
-    None
+    force: bool
+        True -> reload the cities even if the Locations table already has them
 
     Returns
     -------
     None
     '''
-    file_contents = open(US_CITIES,'r')
-    file_reader = csv.reader(file_contents)
-
-    # Skip header row
-    next(file_contents)
-
     insert_location_sql = '''
             INSERT INTO Locations
             VALUES (NULL, ?, ?, ?)
         '''
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    for city_data in file_reader:
-        cur.execute(insert_location_sql,
-            [
-                city_data[0], # City
-                city_data[2], # State
-                'USA',
-            ]
-        )
-    conn.commit()
-    conn.close()
+    if not force and get_db_connection().execute('SELECT EXISTS (SELECT 1 FROM Locations)').fetchone()[0]:
+        return
+
+    # The whole load is one transaction (one disk sync with the WAL journal)
+    with db_writer() as cur:
+        # Opened explicitly: sqlite3 only opens one before an INSERT/UPDATE/DELETE, so the DROP INDEX
+        # would be committed on its own and not rolled back with a failed load
+        cur.execute('BEGIN')
+        # Building the (City, State) index once after the insert is faster than updating it for every row
+        cur.execute('DROP INDEX IF EXISTS "LocationsCityState"')
+        # Restart the Ids so reloading the same CSV gives the same Ids (referenced by Events and Restaurants)
+        cur.execute('DELETE FROM Locations')
+        cur.execute("DELETE FROM sqlite_sequence WHERE name = 'Locations'")
+
+        with open(US_CITIES, 'r') as file_contents:
+            file_reader = csv.reader(file_contents)
+
+            # Skip header row
+            next(file_reader)
+
+            cur.executemany(insert_location_sql, (
+                (
+                    city_data[0], # City
+                    city_data[2], # State
+                    'USA',
+                )
+                for city_data in file_reader
+            ))
+        cur.execute('CREATE INDEX "LocationsCityState" ON "Locations" ("City", "State")')
+
+        # The location ids are known now, so build the in-memory resolver right away
+        location_ids = read_location_ids(cur)
+
+    with LOCATION_IDS_LOCK:
+        LOCATION_IDS.clear()
+        LOCATION_IDS.update(location_ids)
+
+
+# Location Resolution
+def normalize_location_name(name):
+    '''Normalize a city or state name for matching: lower case, no leading/trailing
+    spaces, and single spaces between words.
+    i.e. ' Birch  Run' -> 'birch run'
 
+    Parameters
+    ----------
+    name: string
+        name of a city or a state
 
-def load_events(events_list):
-    '''Insert data into the Dabatabe.
-    Process event data retrieved from crawled & scraped website, and put the processed data into the Database.
+    Returns
+    -------
+    string
+        normalized name
+    '''
+    return " ".join(name.split()).lower()
+
+
+def read_location_ids(cur):
+    '''Read every location of the Locations table.
 
     Parameters
     ----------
-    events_list: list
-        a list of state event dictionaries
-        i.e. michigan_all_events -> a list of dictionaries of all michigan events
-        i.e. [{'event_name': 'Drag Queen Bingo - Bus Stop Bar and Grille', 'event_location': 
-        'The Bus Stop Bar & Grille', 'event_city': ' Birch Run', 'event_state': 'MI', 
-        'event_day': 'Thu', 'event_date': 'Apr 16', 'event_time': '8:00 PM'}]
+    cur: sqlite3.Cursor
+        a cursor of the database
 
     Returns
     -------
+    dict
+        (normalized city, normalized state): Id pairs
+        i.e. {('detroit', 'mi'): 1234, ...}
+    '''
+    location_ids = {}
+    # Like the former "SELECT Id ... WHERE City = ? AND State = ?" lookups, keep the first Id of a duplicated city
+    for location_id, city, state in cur.execute('SELECT Id, City, State FROM Locations ORDER BY Id'):
+        location_ids.setdefault((normalize_location_name(city), normalize_location_name(state)), location_id)
+    return location_ids
+
+
+def get_location_ids():
+    '''Get the (city, state) -> Id resolver, loading it from the database the first time.
+
+    Parameters
+    ----------
     None
+
+    Returns
+    -------
+    dict
+        (normalized city, normalized state): Id pairs
     '''
-    # Step 5
-    select_location_id_sql = '''
-        SELECT Id FROM Locations
-        WHERE City = ? AND State = ?
+    with LOCATION_IDS_LOCK:
+        if not LOCATION_IDS:
+            LOCATION_IDS.update(read_location_ids(get_db_connection().cursor()))
+        return LOCATION_IDS
+
+
+def resolve_location_id(city, state):
+    '''Get the Locations Id of a city in memory (case and whitespace insensitive).
+
+    Parameters
+    ----------
+    city: string
+        name of the city (i.e. ' Birch Run', 'ann arbor')
+    state: string
+        name of the state (two character, i.e. 'MI')
+
+    Returns
+    -------
+    int
+        Id of the location, or None if the city is unknown
     '''
+    return get_location_ids().get((normalize_location_name(city), normalize_location_name(state)))
+
 
-    insert_event_sql = '''
-        INSERT INTO Events
-        VALUES (NULL, ?, ?, ?, ?, ?)
+def get_batches(iterable, batch_size=DB_INSERT_BATCH_SIZE):
+    '''Split an iterable (i.e. a generator of records) into lists of batch_size items.
+
+    Parameters
+    ----------
+    iterable: iterable
+        items to split
+    batch_size: int
+        maximum number of items in a batch
+
+    Yields
+    ------
+    list
+        the next batch of items
     '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
 
-    for row in events_list:
-        cur.execute(select_location_id_sql, [
-            row['event_city'], 
-            row['event_state'],
-            ])
-        res = cur.fetchone()
-        event_location_id = None
-        if res is not None:
-            event_location_id = res[0]
-
-        cur.execute(insert_event_sql, [
-            row['event_name'], # Event Name
-            row['event_day'], # Event day 'Wed'
-            row['event_date'], # Event date i.e. 'Sep 30'
-            row['event_time'], # event_time i.e. 6:00 PM'
-            event_location_id
-        ])
-    conn.commit()
-    conn.close()
+def load_events(events, track_seen=False):
+    '''Insert data into the Dabatabe.
+    Process event data retrieved from crawled & scraped website, and put the processed data into the Database.
 
+    Parameters
+    ----------
+    events: iterable
+        EventRecord items, i.e. the generator returned by crawl_event_pages
+        i.e. EventRecord('Drag Queen Bingo - Bus Stop Bar and Grille', 'The Bus Stop Bar & Grille',
+        ' Birch Run', 'MI', 'Thu', 'Apr 16', '8:00 PM')
+    track_seen: bool
+        True -> the EventKey of every loaded event is recorded in the SeenEvents temp table (see delete_stale_events)
 
-def load_restaurants(restaurant_list, a_city):
+    Returns
+    -------
+    int
+        number of loaded events
+    '''
+    # Step 5
+    # Events already in the database are only rewritten if they changed
+    upsert_event_sql = '''
+        INSERT INTO Events (EventName, Day, Date, Time, LocationId, EventKey)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (EventKey) DO UPDATE SET
+            Day = excluded.Day,
+            LocationId = excluded.LocationId
+        WHERE (Events.Day, Events.LocationId) IS NOT (excluded.Day, excluded.LocationId)
+    '''
+
+    events_count = 0
+    for events_batch in get_batches(events):
+        # Locations are resolved in memory (see resolve_location_id)
+        event_rows = [
+            [
+                an_event.name, # Event Name
+                an_event.day, # Event day 'Wed'
+                an_event.date, # Event date i.e. 'Sep 30'
+                an_event.time, # event_time i.e. 6:00 PM'
+                resolve_location_id(an_event.city, an_event.state),
+                an_event.get_key()
+            ]
+            for an_event in events_batch
+        ]
+        # One short transaction per batch, so the write lock is not held while the next pages are crawled
+        with db_writer() as cur:
+            cur.executemany(upsert_event_sql, event_rows)
+            # Only the aggregates of the cities with loaded events are recomputed
+            refresh_city_stats(cur, {event_row[4] for event_row in event_rows})
+            if track_seen:
+                # Kept in SQLite (not in memory), so a crawl of any size needs the same memory
+                cur.execute('CREATE TEMP TABLE IF NOT EXISTS SeenEvents ("EventKey" TEXT PRIMARY KEY)')
+                cur.executemany('INSERT OR IGNORE INTO temp.SeenEvents VALUES (?)', ((event_row[5],) for event_row in event_rows))
+        events_count += len(events_batch)
+
+    return events_count
+
+
+def load_restaurants(restaurant_list, a_city, refresh=False, state='MI'):
     '''Insert data into the Dabatabe.
     Process restaurnat data retrieved from Yelp Fusion API, and put the processed data into the Database.
 
     Parameters
     ----------
-    restaurant_list: list
-        a list of dictionaries of a user's city restaurant information
+    restaurant_list: iterable
+        a list (or a generator, i.e. iter_restaurant_information) of dictionaries of a user's city restaurant information
         i.e. 	[{
             'id': 'HYrqw4xlLCNDptBHGrTIbQ',
             'alias': 'dime-store-detroit-4',
@@ -605,199 +2106,876 @@ def load_restaurants(restaurant_list, a_city):
     a_city: string
         name of the city (i.e. detroit, ann arbor)
 
+    refresh: bool
+        True -> load the restaurants even if the city was loaded before (rows are upserted)
+
+    state: string
+        name of the state of the city (two character), the restaurants of other states are skipped
+
     Returns
     -------
-    None
+    int
+        number of loaded restaurants (0 if the city was loaded before and refresh is False)
     '''
-    # Step 5
-    select_location_id_sql = '''
-        SELECT Id FROM Locations
-        WHERE City = ? AND State = ?
-    '''
-
     # Becuase the resaurant bus id is unique, I didn't make it as auto increment.
     # Need to get the restaurant bus id as a PK
-    insert_restaurant_sql = '''
+    # Restaurants already in the database are only rewritten if they changed
+    upsert_restaurant_sql = '''
         INSERT INTO Restaurants
         VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (RestaurantId) DO UPDATE SET
+            RestaurantName = excluded.RestaurantName,
+            Price = excluded.Price,
+            Rating = excluded.Rating,
+            TotalReviews = excluded.TotalReviews,
+            PhoneNumber = excluded.PhoneNumber,
+            LocationId = excluded.LocationId
+        WHERE (Restaurants.RestaurantName, Restaurants.Price, Restaurants.Rating, Restaurants.TotalReviews,
+               Restaurants.PhoneNumber, Restaurants.LocationId)
+        IS NOT (excluded.RestaurantName, excluded.Price, excluded.Rating, excluded.TotalReviews,
+                excluded.PhoneNumber, excluded.LocationId)
     '''
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    '''
+    Check if a user searches the city before and the database has one (indexed LoadStatus lookup).
+    '''
+    if not refresh and get_load_status(a_city, 'yelp', state=state) is not None:
+        return 0
+
+    def get_restaurant_rows():
+        for row in restaurant_list:
+            if not (normalize_location_name(row['location']['city']) == normalize_location_name(a_city) and row['location']['state'].lower() == state.lower()):
+                continue
+
+            # Locations are resolved in memory (see resolve_location_id)
+            restaurant_location_id = resolve_location_id(row['location']['city'], row['location']['state'])
+
+            price = None
+            if 'price' in row.keys():
+                price = row['price']
+
+            rating = None
+            if 'rating' in row.keys():
+                rating = row['rating']
+
+            review_count = None
+            if 'review_count' in row.keys():
+                review_count = row['review_count']
+
+            display_phone = None
+            if 'display_phone' in row.keys():
+                if row['display_phone'] == "":
+                    pass
+                else:
+                    display_phone = row['display_phone']
+
+            yield [
+                row['id'], # Restaurant Business Id
+                row['name'], # Restaurant Name
+                price, # Price
+                rating, # Rating
+                review_count, # Total Reviews Count
+                display_phone, # Phone Number
+                restaurant_location_id
+            ]
+
+    # Each batch is inserted while the next Yelp pages are still downloading (restaurant_list can be a generator)
+    restaurants_count = 0
+    seen_restaurant_ids = set()
+    for restaurant_rows in get_batches(get_restaurant_rows()):
+        with db_writer() as cur:
+            cur.executemany(upsert_restaurant_sql, restaurant_rows)
+            # Only the aggregates of the loaded city are recomputed
+            refresh_city_stats(cur, {restaurant_row[6] for restaurant_row in restaurant_rows})
+        restaurants_count += len(restaurant_rows)
+        seen_restaurant_ids.update(restaurant_row[0] for restaurant_row in restaurant_rows)
+
+    # Recorded last, only after every restaurant was fetched: a load stopped by an error
+    # (i.e. a YelpError in the middle of iter_restaurant_information) is done again and prunes nothing
+    with db_writer() as cur:
+        delete_stale_restaurants(cur, resolve_location_id(a_city, state), seen_restaurant_ids)
+        set_load_status(a_city, 'yelp', restaurants_count, state=state, cur=cur)
 
+    return restaurants_count
+
+
+def reset_seen_events():
+    '''Empty the SeenEvents temp table of the writer connection (see load_events).
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
     '''
-    Check if a user searches the city before and the database has one.
-    (If I don't check it, the application crashes when the user checks the same city again.)
+    with db_writer() as cur:
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS SeenEvents ("EventKey" TEXT PRIMARY KEY)')
+        cur.execute('DELETE FROM temp.SeenEvents')
+
+
+def delete_stale_events():
+    '''Delete the events that were not seen in the last crawl (past or removed events),
+    and recompute the CityStats rows of their cities, in one transaction.
+    The seen events are the ones loaded with track_seen since the last reset_seen_events.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    int
+        number of deleted events (0 if the crawl saw too few events, see EVENT_PRUNE_MIN_RATIO)
     '''
+    with db_writer() as cur:
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS SeenEvents ("EventKey" TEXT PRIMARY KEY)')
+        seen_count = cur.execute('SELECT COUNT(*) FROM temp.SeenEvents').fetchone()[0]
+        stored_count = cur.execute('SELECT COUNT(*) FROM Events').fetchone()[0]
+        if not seen_count or seen_count < stored_count * EVENT_PRUNE_MIN_RATIO:
+            return 0
 
-    q = '''
-        SELECT Locations.City
-        FROM Restaurants
-        JOIN Locations
-        ON Restaurants.LocationId = Locations.Id
+        # The seen keys are compared in SQLite (indexed join) instead of reading every stored key
+        stale_filter = 'FROM Events WHERE EventKey NOT IN (SELECT EventKey FROM temp.SeenEvents)'
+        location_ids = {row[0] for row in cur.execute(f'SELECT DISTINCT LocationId {stale_filter}').fetchall()}
+        deleted_count = cur.execute(f'DELETE {stale_filter}').rowcount
+        cur.execute('DELETE FROM temp.SeenEvents')
+
+        refresh_city_stats(cur, location_ids)
+
+    return deleted_count
+
+
+def delete_stale_restaurants(cur, location_id, seen_restaurant_ids):
+    '''Delete the restaurants of a city that were not returned by its last fetch (closed or moved
+    restaurants), and recompute the CityStats row of the city. The caller commits.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        a cursor of the writer connection (see db_writer)
+    location_id: int
+        Id of the city in Locations (None -> nothing is deleted)
+    seen_restaurant_ids: set
+        RestaurantId of every restaurant of the city returned by the fetch (at most YELP_MAX_RESULTS)
+
+    Returns
+    -------
+    int
+        number of deleted restaurants (0 if the fetch returned too few restaurants, see RESTAURANT_PRUNE_MIN_RATIO)
     '''
+    if location_id is None:
+        return 0
+
+    stored_ids = {row[0] for row in cur.execute('SELECT RestaurantId FROM Restaurants WHERE LocationId = ?', [location_id])}
+    if not seen_restaurant_ids or len(seen_restaurant_ids) < len(stored_ids) * RESTAURANT_PRUNE_MIN_RATIO:
+        return 0
 
-    result_q = cur.execute(q).fetchall()
-    # i.e. result_q: [('Detroit',), ('Detroit',), ('Detroit',), ('Detroit',), ('Detroit',), ('Detroit',), 
-    # ('Detroit',), ('Detroit',), ('Detroit',), ('Detroit',), ('Detroit',), ('Detroit',), 
-    # ('Detroit',), ('Detroit',), ('Detroit',), ('Detroit',),…]
+    stale_ids = stored_ids - seen_restaurant_ids
+    if stale_ids:
+        cur.executemany('DELETE FROM Restaurants WHERE RestaurantId = ?', ((restaurant_id,) for restaurant_id in stale_ids))
+        refresh_city_stats(cur, {location_id})
+    return len(stale_ids)
 
-    condition_check = 0
 
-    # For the first time use, there will be empty item in result_q. For that case, just skip "for a_tuple in result_q:" iterataion
-    # and go to "if condition_check == 0: for row in restaurant_list:"
-    if result_q:
-        for a_tuple in result_q:
-            if a_city != a_tuple[0].lower():
-                pass
+def refresh_events(states, event_url_template=EVENTBRITE_STATE_URL, max_pages=None):
+    '''Crawl the events of some states again and write only the differences: new and changed events are
+    upserted (unchanged rows are not rewritten) and the events missing from the crawl are deleted
+    (including the events of states that are not crawled anymore).
+    Fetching, parsing and inserting overlap: every batch is inserted while the next pages are crawled.
+
+    Parameters
+    ----------
+    states: list
+        names of the states (two character, i.e. EVENT_CRAWL_STATES)
+    event_url_template: string
+        url with a {state_slug} field (i.e. EVENTBRITE_STATE_URL)
+    max_pages: int
+        the most pages to crawl per state (None -> EVENT_CRAWL_MAX_PAGES)
+
+    Returns
+    -------
+    tuple
+        (number of crawled events, number of deleted events)
+    '''
+    # One refresh at a time (they share the SeenEvents table)
+    with EVENT_REFRESH_LOCK:
+        reset_seen_events()
+
+        state_events_counts = {}
+        # The states are crawled in parallel processes and loaded here (one writer) batch by batch
+        for state_name, events_batch in crawl_states(states, event_url_template, max_pages=max_pages):
+            if events_batch is None:
+                set_load_status(ALL_CITIES, 'eventbrite', state_events_counts.get(state_name, 0), state=state_name)
             else:
-                condition_check += 1
+                state_events_counts[state_name] = state_events_counts.get(state_name, 0) + load_events(events_batch, track_seen=True)
+        deleted_count = delete_stale_events()
 
-    if condition_check == 0:
-        for row in restaurant_list:
-            if row['location']['city'].lower() == a_city and row['location']['state'].lower() == "mi":
-                cur.execute(select_location_id_sql, [
-                    row['location']['city'], 
-                    row['location']['state'],
-                    ])
-                res = cur.fetchone()
-                restaurant_location_id = None
-                if res is not None:
-                    restaurant_location_id = res[0]
-
-                price = None
-                if 'price' in row.keys():
-                    price = row['price']
-
-                rating = None
-                if 'rating' in row.keys():
-                    rating = row['rating']
-
-                review_count = None
-                if 'review_count' in row.keys():
-                    review_count = row['review_count']
-
-                display_phone = None
-                if 'display_phone' in row.keys():
-                    if row['display_phone'] == "":
-                        pass
-                    else:
-                        display_phone = row['display_phone']
-
-                cur.execute(insert_restaurant_sql, [
-                    row['id'], # Restaurant Business Id
-                    row['name'], # Restaurant Name
-                    price, # Price
-                    rating, # Rating
-                    review_count, # Total Reviews Count
-                    display_phone, # Phone Number
-                    restaurant_location_id
-                ])
-        conn.commit()
-        conn.close()
+    return sum(state_events_counts.values()), deleted_count
+
+
+def events_need_refresh(states):
+    '''Check if the events of one of the states have to be (re)loaded.
+
+    Parameters
+    ----------
+    states: list
+        names of the states (two character, i.e. EVENT_CRAWL_STATES)
+
+    Returns
+    -------
+    bool
+        True if the events of a state were never loaded or are older than EVENT_REFRESH_SECONDS
+    '''
+    return any(needs_refresh(ALL_CITIES, 'eventbrite', EVENT_REFRESH_SECONDS, state=state_name) for state_name in states)
+
+
+# Load Status
+def get_load_status(a_city, source, state='MI', cur=None):
+    '''Get when the data of a source was loaded for a city (indexed lookup in LoadStatus).
+
+    Parameters
+    ----------
+    a_city: string
+        name of the city (i.e. detroit, ann arbor), or ALL_CITIES for a whole state
+    source: string
+        'yelp' (restaurants) or 'eventbrite' (events)
+    state: string
+        name of the state (two character)
+    cur: sqlite3.Cursor
+        a cursor of the database (None -> the read connection of get_db_connection)
+
+    Returns
+    -------
+    tuple
+        (FetchedAt, RowCount), or None if the data was never loaded
+        i.e. (1587168000.0, 696)
+    '''
+    select_load_status_sql = '''
+        SELECT FetchedAt, RowCount FROM LoadStatus
+        WHERE City = ? AND State = ? AND Source = ?
+    '''
+
+    if cur is None:
+        cur = get_db_connection()
+    return cur.execute(select_load_status_sql, [normalize_location_name(a_city), state.upper(), source]).fetchone()
+
+
+def set_load_status(a_city, source, row_count, state='MI', cur=None):
+    '''Record that the data of a source was just loaded for a city.
+
+    Parameters
+    ----------
+    a_city: string
+        name of the city (i.e. detroit, ann arbor), or ALL_CITIES for a whole state
+    source: string
+        'yelp' (restaurants) or 'eventbrite' (events)
+    row_count: int
+        number of loaded rows
+    state: string
+        name of the state (two character)
+    cur: sqlite3.Cursor
+        a cursor of the database, the caller commits (None -> write in its own db_writer transaction)
+
+    Returns
+    -------
+    None
+    '''
+    upsert_load_status_sql = '''
+        INSERT INTO LoadStatus VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (City, State, Source) DO UPDATE SET
+            FetchedAt = excluded.FetchedAt,
+            RowCount = excluded.RowCount
+    '''
+    values = [normalize_location_name(a_city), state.upper(), source, time.time(), row_count]
+
+    if cur is None:
+        with db_writer() as cur:
+            cur.execute(upsert_load_status_sql, values)
     else:
-        conn.commit()
-        conn.close()
+        cur.execute(upsert_load_status_sql, values)
+
+
+def needs_refresh(a_city, source, max_age, state='MI'):
+    '''Check if the data of a source has to be (re)loaded for a city.
+
+    Parameters
+    ----------
+    a_city: string
+        name of the city (i.e. detroit, ann arbor), or ALL_CITIES for a whole state
+    source: string
+        'yelp' (restaurants) or 'eventbrite' (events)
+    max_age: float
+        maximum age of the data in seconds (i.e. RESTAURANT_REFRESH_SECONDS)
+    state: string
+        name of the state (two character)
+
+    Returns
+    -------
+    bool
+        True if the data was never loaded or is older than max_age
+    '''
+    load_status = get_load_status(a_city, source, state=state)
+    return load_status is None or time.time() - load_status[0] > max_age
+
+
+# Background Prefetch
+def fetch_and_load_restaurants(a_city, state='MI'):
+    '''Get the restaurants of a city from YELP Fusion API and put them into the database.
+
+    Parameters
+    ----------
+    a_city: string
+        name of the city (i.e. detroit, ann arbor)
+    state: string
+        name of the state (two character)
+
+    Returns
+    -------
+    int
+        number of loaded restaurants of the city
+    '''
+    # Streamed from YELP Fusion API into the database (see iter_restaurant_information and load_restaurants)
+    return load_restaurants(iter_restaurant_information(a_city, state), a_city, refresh=True, state=state)
+
+
+def claim_prefetch(a_city, state='MI'):
+    '''Record in LoadStatus that this process starts the prefetch job of a city, unless another
+    process recorded it less than PREFETCH_CLAIM_SECONDS ago (one atomic upsert).
+
+    Parameters
+    ----------
+    a_city: string
+        name of the city (i.e. detroit, ann arbor)
+    state: string
+        name of the state (two character)
+
+    Returns
+    -------
+    bool
+        True if this process runs the job
+    '''
+    claim_prefetch_sql = '''
+        INSERT INTO LoadStatus VALUES (?, ?, ?, ?, 0)
+        ON CONFLICT (City, State, Source) DO UPDATE SET
+            FetchedAt = excluded.FetchedAt
+        WHERE LoadStatus.FetchedAt < ?
+    '''
+    now = time.time()
+
+    with db_writer() as cur:
+        cur.execute(claim_prefetch_sql, [normalize_location_name(a_city), state.upper(), PREFETCH_CLAIM_SOURCE, now, now - PREFETCH_CLAIM_SECONDS])
+        return cur.rowcount == 1
+
+
+def get_prefetch_claim(a_city, state='MI'):
+    '''Get when a prefetch job of a city was claimed, if the claim is still valid (see claim_prefetch).
+
+    Parameters
+    ----------
+    a_city: string
+        name of the city (i.e. detroit, ann arbor)
+    state: string
+        name of the state (two character)
+
+    Returns
+    -------
+    float
+        time of the claim, or None if no job of the city is running
+    '''
+    prefetch_claim = get_load_status(a_city, PREFETCH_CLAIM_SOURCE, state=state)
+    if prefetch_claim is not None and time.time() - prefetch_claim[0] < PREFETCH_CLAIM_SECONDS:
+        return prefetch_claim[0]
+    return None
+
+
+def run_prefetch_job(a_city, state='MI'):
+    '''Load the restaurants of a city (see fetch_and_load_restaurants), then remove the LoadStatus record
+    of the job (see claim_prefetch). Runs in a prefetch executor (see prefetch_restaurants).
+    The job is claimed when it starts, not when it is queued, so a job waiting in a queue does not hold
+    (or lose) the claim. It is dropped if another process claimed the city or loaded it meanwhile.
+
+    Parameters
+    ----------
+    a_city: string
+        name of the city (i.e. detroit, ann arbor)
+    state: string
+        name of the state (two character)
+
+    Returns
+    -------
+    int
+        number of loaded restaurants of the city, or None if the job was dropped
+    '''
+    if not needs_refresh(a_city, 'yelp', RESTAURANT_REFRESH_SECONDS, state=state):
+        return None
+    if not claim_prefetch(a_city, state):
+        return None
+
+    try:
+        return fetch_and_load_restaurants(a_city, state)
+    finally:
+        with db_writer() as cur:
+            cur.execute('DELETE FROM LoadStatus WHERE City = ? AND State = ? AND Source = ?',
+                        [normalize_location_name(a_city), state.upper(), PREFETCH_CLAIM_SOURCE])
+
+
+def prefetch_restaurants(a_city, state='MI', executor=None):
+    '''Start loading the restaurants of a city in the background, unless they were loaded recently
+    or a job of the city is already running (in this process or in another one, see claim_prefetch).
+
+    Parameters
+    ----------
+    a_city: string
+        name of the city (i.e. detroit, ann arbor)
+    state: string
+        name of the state (two character)
+    executor: concurrent.futures.Executor
+        executor that runs the job (None -> PREFETCH_EXECUTOR)
+
+    Returns
+    -------
+    concurrent.futures.Future
+        the job of the city, or None if the restaurants in the database are recent, the job runs
+        in another process (see get_prefetch_status), or the database is a read-only snapshot
+    '''
+    if DB_READ_ONLY:
+        return None
+
+    job_key = (normalize_location_name(a_city), state.upper())
+    executor = executor or PREFETCH_EXECUTOR
+
+    with PREFETCH_JOBS_LOCK:
+        job_executor, job = PREFETCH_JOBS.get(job_key, (None, None))
+        if job is not None and not job.done():
+            # A job still queued behind the background refreshes (or a batch comparison) is not waited for:
+            # the same job is queued here too, and the copy that starts last is dropped (see run_prefetch_job)
+            if job.running() or job_executor is executor or executor is REFRESH_PREFETCH_EXECUTOR:
+                return job
+        if not needs_refresh(a_city, 'yelp', RESTAURANT_REFRESH_SECONDS, state=state):
+            return None
+        if get_prefetch_claim(a_city, state) is not None:
+            return None
+        job = executor.submit(run_prefetch_job, job_key[0], state)
+        PREFETCH_JOBS[job_key] = (executor, job)
+
+    return job
+
+
+def get_prefetch_status(a_city, state='MI'):
+    '''Get the status of the restaurant prefetch job of a city. Without a job in this process
+    (or if it was dropped, see run_prefetch_job), LoadStatus tells if a job runs in another process
+    or the restaurants were loaded.
+
+    Parameters
+    ----------
+    a_city: string
+        name of the city (i.e. detroit, ann arbor)
+    state: string
+        name of the state (two character)
+
+    Returns
+    -------
+    string
+        'none' (no job and no recent restaurants), 'running', 'done', or 'failed'
+    '''
+    with PREFETCH_JOBS_LOCK:
+        job = PREFETCH_JOBS.get((normalize_location_name(a_city), state.upper()), (None, None))[1]
+
+    if job is not None and not job.done():
+        return 'running'
+    if job is not None and job.exception() is not None:
+        return 'failed'
+    if job is not None and job.result() is not None:
+        return 'done'
+
+    if get_prefetch_claim(a_city, state) is not None:
+        return 'running'
+    if not needs_refresh(a_city, 'yelp', RESTAURANT_REFRESH_SECONDS, state=state):
+        return 'done'
+    return 'none'
+
+
+# Statewide Precompute
+def precompute_restaurants(state='MI', limit=None, max_workers=PRECOMPUTE_MAX_WORKERS, max_age=RESTAURANT_REFRESH_SECONDS):
+    '''Load the restaurants of every city of a state, the most populated first, so every comparison
+    is served from the database. LoadStatus is the checkpoint: the cities loaded less than max_age
+    ago are skipped, so an interrupted run continues where it stopped.
+
+    Parameters
+    ----------
+    state: string
+        name of the state (two character)
+    limit: int
+        only the limit most populated cities (None -> all), i.e. to stay in the daily Yelp quota
+    max_workers: int
+        number of cities fetched at the same time
+    max_age: float
+        cities loaded longer ago than this (in seconds) are loaded again
+
+    Returns
+    -------
+    dict
+        {'loaded': number of loaded cities, 'skipped': number of cities already loaded,
+         'failed': names of the cities that could not be loaded (tried again at the next run)}
+    '''
+    select_loaded_cities_sql = '''
+        SELECT City FROM LoadStatus
+        WHERE State = ? AND Source = 'yelp' AND FetchedAt >= ?
+    '''
+    loaded_cities = {row[0] for row in get_db_connection().execute(select_loaded_cities_sql, [state.upper(), time.time() - max_age])}
+
+    cities = get_cities_name(state, by_population=True)[:limit]
+    pending_cities = [a_city for a_city in cities if a_city not in loaded_cities]
+    summary = {'loaded': 0, 'skipped': len(cities) - len(pending_cities), 'failed': []}
+
+    def load_city(a_city):
+        try:
+            return fetch_and_load_restaurants(a_city, state)
+        except Exception as error:
+            print(f"Restaurants of {a_city} could not be loaded: {error}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # executor.map keeps the population order in the progress output
+        for i, (a_city, restaurants_count) in enumerate(zip(pending_cities, executor.map(load_city, pending_cities)), 1):
+            if restaurants_count is None:
+                summary['failed'].append(a_city)
+            else:
+                summary['loaded'] += 1
+            print(f"[{i}/{len(pending_cities)}] {a_city}: {restaurants_count} restaurants")
+
+    return summary
+
+
+# Refresh Scheduler
+def get_stale_cities(source, max_age, state=None):
+    '''Get the cities whose data of a source is older than max_age (scan of LoadStatus).
+
+    Parameters
+    ----------
+    source: string
+        'yelp' (restaurants) or 'eventbrite' (events)
+    max_age: float
+        maximum age of the data in seconds (i.e. RESTAURANT_REFRESH_SECONDS)
+    state: string
+        name of the state (two character), None -> every state (i.e. the states of precompute_restaurants)
+
+    Returns
+    -------
+    list
+        (lower cased city name, state) pairs, the oldest first (i.e. [('detroit', 'MI'), ('columbus', 'OH')])
+    '''
+    select_stale_cities_sql = '''
+        SELECT City, State FROM LoadStatus
+        WHERE (? IS NULL OR State = ?) AND Source = ? AND City != ? AND FetchedAt < ?
+        ORDER BY FetchedAt
+    '''
+    state = state.upper() if state is not None else None
+    rows = get_db_connection().execute(select_stale_cities_sql, [state, state, source, ALL_CITIES, time.time() - max_age]).fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+
+def run_refresh():
+    '''Refresh the data that got old: the state events (see refresh_events), and the restaurants
+    of Detroit and of the cities loaded before (in any state), at most REFRESH_MAX_CITIES per run
+    (as prefetch jobs in REFRESH_PREFETCH_EXECUTOR, see prefetch_restaurants).
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    '''
+    if events_need_refresh(EVENT_CRAWL_STATES):
+        try:
+            events_count, deleted_count = refresh_events(EVENT_CRAWL_STATES, EVENTBRITE_STATE_URL)
+            print(f"Refreshed events of {', '.join(EVENT_CRAWL_STATES)}: {events_count} crawled, {deleted_count} deleted")
+        except Exception as error:
+            # The restaurants are still refreshed, the events are tried again at the next interval
+            print(f"Refreshing the events failed: {error}")
+
+    # The cities of every state (each one is fetched with its own state)
+    stale_cities = get_stale_cities('yelp', RESTAURANT_REFRESH_SECONDS)
+    if needs_refresh("detroit", 'yelp', RESTAURANT_REFRESH_SECONDS) and ("detroit", 'MI') not in stale_cities:
+        stale_cities.insert(0, ("detroit", 'MI'))
+    # The other cities are refreshed by the next runs, the oldest first
+    for a_city, state_name in stale_cities[:REFRESH_MAX_CITIES]:
+        prefetch_restaurants(a_city, state=state_name, executor=REFRESH_PREFETCH_EXECUTOR)
+
+
+def start_refresh_scheduler(interval=REFRESH_INTERVAL_SECONDS):
+    '''Run run_refresh every interval seconds in a daemon thread, while the app keeps serving
+    the data already in the database.
+
+    Parameters
+    ----------
+    interval: float
+        seconds between two refreshes
+
+    Returns
+    -------
+    threading.Event
+        set it to stop the scheduler
+    '''
+    stop_event = threading.Event()
+
+    def refresh_loop():
+        # The first wait lets the startup load finish
+        while not stop_event.wait(interval):
+            try:
+                run_refresh()
+            except Exception as error:
+                # Try again at the next interval
+                print(f"Refresh failed: {error}")
+
+    threading.Thread(target=refresh_loop, name='refresh-scheduler', daemon=True).start()
+    return stop_event
+
+
+# City Statistics
+def migrate_city_stats(cur):
+    '''Schema version 3: create the CityStats table and compute it for the data already loaded.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        a cursor of the database (inside the migration transaction)
+
+    Returns
+    -------
+    None
+    '''
+    cur.execute('''
+        CREATE TABLE "CityStats" (
+            "LocationId" INTEGER PRIMARY KEY,
+            "TotalEvents" INTEGER NOT NULL DEFAULT 0,
+            "WeekendEvents" INTEGER NOT NULL DEFAULT 0,
+            "WeekdayEvents" INTEGER NOT NULL DEFAULT 0,
+            "RestaurantCount" INTEGER NOT NULL DEFAULT 0,
+            "RatingSum" REAL NOT NULL DEFAULT 0,
+            "RatedCount" INTEGER NOT NULL DEFAULT 0,
+            "RatingHistogram" TEXT NOT NULL DEFAULT '{}',
+            "UpdatedAt" REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    location_ids = [row[0] for row in cur.execute('''
+        SELECT LocationId FROM Events WHERE LocationId IS NOT NULL
+        UNION
+        SELECT LocationId FROM Restaurants WHERE LocationId IS NOT NULL
+    ''').fetchall()]
+    refresh_city_stats(cur, location_ids)
+
+
+def refresh_city_stats(cur, location_ids):
+    '''Recompute the CityStats rows of some locations from the Events and Restaurants tables.
+    Called by load_events and load_restaurants with the locations they just loaded, so the
+    results page can read the numbers of a city with one primary key lookup.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        a cursor of the database, the caller commits
+    location_ids: iterable
+        Locations Ids to recompute (None items are ignored)
+
+    Returns
+    -------
+    None
+    '''
+    weekend_placeholders = ", ".join("?" for _ in WEEKEND_DAYS)
+    upsert_city_stats_sql = '''
+        INSERT INTO CityStats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (LocationId) DO UPDATE SET
+            TotalEvents = excluded.TotalEvents,
+            WeekendEvents = excluded.WeekendEvents,
+            WeekdayEvents = excluded.WeekdayEvents,
+            RestaurantCount = excluded.RestaurantCount,
+            RatingSum = excluded.RatingSum,
+            RatedCount = excluded.RatedCount,
+            RatingHistogram = excluded.RatingHistogram,
+            UpdatedAt = excluded.UpdatedAt
+    '''
+
+    location_ids = [location_id for location_id in set(location_ids) if location_id is not None]
+    now = time.time()
+
+    # SQLite limits the number of parameters of a statement
+    for ids_batch in get_batches(location_ids):
+        id_placeholders = ", ".join("?" for _ in ids_batch)
+
+        # [TotalEvents, WeekendEvents, WeekdayEvents, RestaurantCount, RatingSum, RatedCount, RatingHistogram]
+        city_stats = {location_id: [0, 0, 0, 0, 0.0, 0, {}] for location_id in ids_batch}
+
+        # Like the former query: an event without a day is neither a weekend nor a weekday event
+        events_query = f'''
+            SELECT LocationId, COUNT(*),
+                SUM(Day IN ({weekend_placeholders})),
+                SUM(Day NOT IN ({weekend_placeholders}))
+            FROM Events
+            WHERE LocationId IN ({id_placeholders})
+            GROUP BY LocationId
+        '''
+        for location_id, total, weekend, weekday in cur.execute(events_query, [*WEEKEND_DAYS, *WEEKEND_DAYS, *ids_batch]):
+            city_stats[location_id][0:3] = [total, weekend or 0, weekday or 0]
+
+        restaurants_query = f'''
+            SELECT LocationId, Rating, COUNT(*)
+            FROM Restaurants
+            WHERE LocationId IN ({id_placeholders})
+            GROUP BY LocationId, Rating
+        '''
+        for location_id, rating, count in cur.execute(restaurants_query, ids_batch):
+            a_city_stats = city_stats[location_id]
+            a_city_stats[3] += count
+            if rating is not None:
+                a_city_stats[4] += rating * count
+                a_city_stats[5] += count
+                # i.e. {"4.5": 120, "4.0": 310}
+                a_city_stats[6][str(rating)] = count
+
+        cur.executemany(upsert_city_stats_sql, [
+            [location_id, *a_city_stats[:6], json.dumps(a_city_stats[6], sort_keys=True), now]
+            for location_id, a_city_stats in city_stats.items()
+        ])
 
 
 '''
 Part 5: Data Processing
 '''
-# Restaurant Query
-def restaurants_query_process(a_city, data_selection):
-    '''Process restaurants query and return result as a list of tuple(s)
+# Comparison Query
+def compare_cities(cities, data_selections, state='MI'):
+    '''Get several data selections for several cities with one parameterized query
+    on the CityStats aggregates.
 
     Parameters
     ----------
-    a_city: string (lower case)
-        name of a city (i.e. detroit, ann arbor)
-
-    data_selection: string
-        name of the data selection
-        (i.e. total_number_of_restaurants, average_restaurant_rating)
+    cities: list
+        names of the cities (i.e. ['detroit', 'ann arbor'])
+    data_selections: list
+        names of the data selections (keys of DATA_SELECTION_COLUMNS)
+        (i.e. ['total_number_of_events', 'average_restaurant_rating'])
+    state: string
+        name of the state (two character)
 
     Returns
     -------
-    list
-        result as a list of tuple(s)
-        # i.e. [(696, 'Detroit')] <= Total Restaurants numbers in Detroit
-        # i.e. [(3.9331896551724137, 'Detroit')] <= Average Rating in Detroit
+    dict
+        normalized city name: {data selection: value} pairs
+        i.e. {'detroit': {'total_number_of_events': 180, 'average_restaurant_rating': 3.9331896551724137},
+              'ann arbor': {'total_number_of_events': 61, 'average_restaurant_rating': 4.0215}}
     '''
-    a_city_capital = capitalize_city_name(a_city)
-
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    for data_selection in data_selections:
+        if data_selection not in DATA_SELECTION_COLUMNS:
+            raise ValueError(f"Unknown data selection: {data_selection}")
+
+    # Cities without data (or unknown cities) keep the "no data" values
+    comparison = {}
+    ids_to_cities = {}
+    for a_city in cities:
+        normalized_city = normalize_location_name(a_city)
+        comparison[normalized_city] = {
+            data_selection: DATA_SELECTION_COLUMNS[data_selection][1] for data_selection in data_selections
+        }
+        location_id = resolve_location_id(a_city, state)
+        if location_id is not None:
+            ids_to_cities.setdefault(location_id, []).append(normalized_city)
 
-    if data_selection == 'total_number_of_restaurants':
-        select_item = 'COUNT(*)'
-    else:
-        select_item = 'AVG(Restaurants.Rating)'
+    if not ids_to_cities or not data_selections:
+        return comparison
 
+    select_items = ", ".join(DATA_SELECTION_COLUMNS[data_selection][0] for data_selection in data_selections)
+    id_placeholders = ", ".join("?" for _ in ids_to_cities)
+    # Only whitelisted column expressions and placeholders go into the SQL text
     query = f'''
-        SELECT {select_item}, Locations.City
-        FROM Restaurants
-        JOIN Locations
-        ON Restaurants.LocationId = Locations.Id
-        WHERE Locations.City = "{a_city_capital}"
+        SELECT LocationId, {select_items}
+        FROM CityStats
+        WHERE LocationId IN ({id_placeholders})
     '''
 
-    print(f"SQL Query: {query}")
+    for row in get_db_connection().execute(query, list(ids_to_cities)):
+        for normalized_city in ids_to_cities[row[0]]:
+            comparison[normalized_city] = dict(zip(data_selections, row[1:]))
 
-    cur.execute(query)
-    result = cur.fetchall()
+    return comparison
 
-    conn.close()
-
-    return result
 
-
-# Events Query
-def events_query_process(a_city, data_selection):
-    '''Process event query and return result as a list of tuple(s)
+def compare_city_batch(cities, data_selections, state='MI', wait_seconds=COMPARE_WAIT_SECONDS):
+    '''Compare many cities on many data selections at once. The restaurants of the cities that
+    need them are prefetched concurrently in COMPARE_PREFETCH_EXECUTOR (see prefetch_restaurants),
+    then every value is read with one compare_cities query.
 
     Parameters
     ----------
-    a_city: string (lower case)
-        name of a city (i.e. detroit, ann arbor)
-
-    data_selection: string
-        name of the data selection
-        (i.e. total_number_of_events, total_number_of_events_on_weekend, total_number_of_events_on_weekday)
+    cities: list
+        names of the cities (i.e. ['detroit', 'ann arbor', 'lansing'])
+    data_selections: list
+        names of the data selections (keys of DATA_SELECTION_COLUMNS)
+    state: string
+        name of the state (two character)
+    wait_seconds: float
+        maximum time to wait for the prefetch jobs (all together)
 
     Returns
     -------
-    list
-        result as a list of tuple(s)
-        # i.e. [(180, 'Detroit')] <= Total Events numbers in Detroit
+    tuple
+        (comparison as returned by compare_cities,
+         list of the cities whose restaurants were still loading, their values are the ones in the database)
     '''
-    a_city_capital = capitalize_city_name(a_city)
-
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    pending_cities = []
+
+    if any(data_selection in RESTAURANT_DATA_SELECTIONS for data_selection in data_selections):
+        # All jobs are started before waiting for any of them
+        prefetch_jobs = {a_city: prefetch_restaurants(a_city, state=state, executor=COMPARE_PREFETCH_EXECUTOR) for a_city in cities}
+        deadline = time.monotonic() + wait_seconds
+        for a_city, prefetch_job in prefetch_jobs.items():
+            if prefetch_job is not None:
+                try:
+                    prefetch_job.result(timeout=max(deadline - time.monotonic(), 0))
+                except FutureTimeoutError:
+                    pending_cities.append(a_city)
+                    continue
+                except Exception as error:
+                    print(f"Restaurants of {a_city} could not be loaded: {error}")
+                    continue
+            # Loaded by another process serving the app
+            if get_prefetch_status(a_city, state) == 'running':
+                pending_cities.append(a_city)
+
+    return compare_cities(cities, data_selections, state=state), pending_cities
+
+
+def get_city_stats_version(cities, state='MI'):
+    '''Get when the CityStats rows of some cities were last recomputed (see refresh_city_stats).
+    The version changes whenever the data of one of the cities changes.
 
-    if data_selection == 'total_number_of_events':
-        where_item = ""
-    elif data_selection == 'total_number_of_events_on_weekend':
-        where_item = 'AND (Events.Day = "Sat" or Events.Day = "Sun")'
-    else:
-        where_item  = 'AND (Events.Day != "Sat" AND Events.Day != "Sun")'
+    Parameters
+    ----------
+    cities: list
+        names of the cities (i.e. ['detroit', 'ann arbor'])
+    state: string
+        name of the state (two character)
 
-    query = f'''
-        SELECT COUNT(*), Locations.City
-        FROM Events
-        JOIN Locations
-        ON Events.LocationId = Locations.Id
-        WHERE Locations.City = "{a_city_capital}" {where_item}
+    Returns
+    -------
+    tuple
+        UpdatedAt of every city in the same order, None for a city without data
+        i.e. (1587168000.0, 1587170000.0)
     '''
+    location_ids = [resolve_location_id(a_city, state) for a_city in cities]
+    known_ids = [location_id for location_id in location_ids if location_id is not None]
 
-    print(f"SQL Query: {query}")
-
-    cur.execute(query)
-    result = cur.fetchall()
+    updated_at = {}
+    if known_ids:
+        id_placeholders = ", ".join("?" for _ in known_ids)
+        query = f'SELECT LocationId, UpdatedAt FROM CityStats WHERE LocationId IN ({id_placeholders})'
+        updated_at = dict(get_db_connection().execute(query, known_ids).fetchall())
 
-    conn.close()
+    return tuple(updated_at.get(location_id) for location_id in location_ids)
 
-    return result
 
 # Assistive function to capitalize city name
 def capitalize_city_name(a_city):
@@ -834,6 +3012,24 @@ def capitalize_city_name(a_city):
     return a_city_capital
 
 
+# Assistive function to make the title of a data selection
+def configure_data_selection(data_selection):
+    '''Make the title of a data selection.
+
+    Parameters
+    ----------
+    data_selection: string
+        name of a data selection (i.e. total_number_of_restaurants)
+
+    Returns
+    -------
+    string
+        title of the data selection
+        # i.e. Total Number Of Restaurants
+    '''
+    return " ".join(word.capitalize() for word in data_selection.split('_'))
+
+
 
 # Configure float formatting
 def float_formatting(float_number):
@@ -860,6 +3056,69 @@ def float_formatting(float_number):
 Part 6: Data Presentation (Flask and Plotly)
 '''
 # app -> defined on the top
+# Results Cache
+def get_cached_results(results_key, version):
+    '''Get a rendered results page from RESULTS_CACHE if the data it shows did not change.
+
+    Parameters
+    ----------
+    results_key: tuple
+        (user's city, data selection, barplot) i.e. ('Ann Arbor', 'total_number_of_events', True)
+    version: tuple
+        CityStats version of the compared cities (see get_city_stats_version)
+
+    Returns
+    -------
+    string
+        the html of the page, or None if it is not cached or out of date
+    '''
+    with RESULTS_CACHE_LOCK:
+        cached = RESULTS_CACHE.get(results_key)
+        if cached is None or cached[0] != version:
+            return None
+        RESULTS_CACHE.move_to_end(results_key)
+        return cached[1]
+
+
+def store_results(results_key, version, html):
+    '''Put a rendered results page into RESULTS_CACHE (evicting the least recently used pages).
+
+    Parameters
+    ----------
+    results_key: tuple
+        (user's city, data selection, barplot)
+    version: tuple
+        CityStats version of the compared cities (see get_city_stats_version)
+    html: string
+        the rendered page
+
+    Returns
+    -------
+    None
+    '''
+    with RESULTS_CACHE_LOCK:
+        RESULTS_CACHE[results_key] = (version, html)
+        RESULTS_CACHE.move_to_end(results_key)
+        while len(RESULTS_CACHE) > RESULTS_CACHE_SIZE:
+            RESULTS_CACHE.popitem(last=False)
+
+
+def get_plotly_version():
+    '''Get the version of the installed plotly (used in the plotly.js url, so a new version is downloaded again).
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        i.e. "5.24.1"
+    '''
+    import plotly
+
+    return plotly.__version__
+
 # Home page
 @app.route('/')
 def index():
@@ -874,8 +3133,6 @@ def index():
     html template
         return index.html template
     '''
-    # Clear user_city list so that it can take new one every time.
-    user_city.clear()
     return render_template('index.html')
 
 # Options Page
@@ -894,18 +3151,41 @@ def options():
         return 'options.html' template or 'error.html' template if there's an error with user_city
         parameter.
     '''
-    mi_cities_lowered = get_cities_name("MI")
-    # mi_cities_lowered -> a list of MI chities lowered (i.e. ann arbor, lansing)
     user_input = request.form['city_input']
-    user_input_lower = user_input.lower()
 
-    # user_city (list) was defined on the top so that other function can use it too.
-    user_city.append(capitalize_city_name(user_input))
+    # The next pages get the city from the form (see category and results)
+    user_city = capitalize_city_name(user_input)
 
-    if user_input_lower in mi_cities_lowered:
-        return render_template('options.html', user_city=user_city[0])
+    # O(1) membership check in the city index (built once at startup)
+    if get_city_index().contains("MI", user_input):
+        # Start getting the city's restaurants while the user picks a category
+        prefetch_restaurants(user_input)
+        return render_template('options.html', user_city=user_city)
     else:
-        return render_template('error.html', user_city=user_city[0])
+        return render_template('error.html', user_city=user_city)
+
+# City Autocomplete
+@app.route('/cities/autocomplete')
+def cities_autocomplete():
+    ''' Return city suggestions for the text typed in the city input as JSON.
+
+    Parameters
+    ----------
+    None (query string: q -> typed text, state -> two character state (default MI),
+    limit -> maximum number of suggestions)
+
+    Returns
+    -------
+    json
+        i.e. {"query": "ann", "cities": ["Ann Arbor"]}
+    '''
+    query = request.args.get('q', '')
+    state_name = request.args.get('state', 'MI')
+    limit = min(request.args.get('limit', CITY_SUGGESTIONS_LIMIT, type=int), CITY_SUGGESTIONS_LIMIT)
+
+    cities = get_city_index().suggest(state_name, query, limit=max(limit, 0))
+
+    return jsonify({'query': query, 'cities': cities})
 
 # Category Page
 @app.route('/category', methods=['POST'])
@@ -919,7 +3199,7 @@ def category():
     Returns
     -------
     html template with parameters
-        return 'category.html' template with category and category_capitalize parameters.
+        return 'category.html' template with category, category_capitalize and user_city parameters.
     '''
     # category is either "events" or "restaurants"
     category = request.form['category_compare']
@@ -927,7 +3207,8 @@ def category():
     # For category url (events)
     category_capitalize = category.capitalize()
 
-    return render_template('category.html', category=category, category_capitalize=category_capitalize)
+    return render_template('category.html', category=category, category_capitalize=category_capitalize,
+    user_city=request.form['user_city'])
 
 # Results Page
 @app.route('/category/<category>/results', methods=['POST'])
@@ -947,22 +3228,21 @@ def results(category):
         return 'results.html' template with parameters.
     '''
     data_selection = request.form['category_radio']
-    data_selection_split = data_selection.split('_')
-
-    data_selection_configured = ''
+    # The data selection comes from the form too (see compare_cities)
+    if data_selection not in DATA_SELECTION_COLUMNS:
+        return render_template('error.html', message=f'"{data_selection}" is not a data selection'), 400
+    # Convert data_selection i.e. "total_number_of_restaurants" to "Total Number Of Restaurants"
+    data_selection_configured = configure_data_selection(data_selection)
 
-    user_city_results = user_city[0]
+    user_city_results = request.form['user_city']
     user_city_results_lower = user_city_results.lower()
 
-    # Convert data_selection i.e. "total_number_of_restaurants" to "Total Number Of Restaurants"
-    for i in range(len(data_selection_split)):
-        if i < (len(data_selection_split)-1):
-            data_selection_configured += data_selection_split[i].capitalize() + " "
-        else:
-            data_selection_configured += data_selection_split[i].capitalize()
+    # The city comes from the form, so check it again
+    if not get_city_index().contains("MI", user_city_results):
+        return render_template('error.html', user_city=user_city_results)
 
     # Restaurants
-    if data_selection == 'total_number_of_restaurants' or data_selection == 'average_restaurant_rating':
+    if data_selection in RESTAURANT_DATA_SELECTIONS:
         '''
         Detroit's City's Restaurant (# Get Detroit's Restaurant information and put it to the DB)
         => should be already done in the main section.
@@ -971,55 +3251,73 @@ def results(category):
         '''
         User's City's Restaurant
         '''
-        # Get User's City's Restaurant information and put it to the DB
-        user_city_restaurants = get_restaurant_information(user_city_results_lower)
-        load_restaurants(user_city_restaurants, user_city_results_lower)
-
-        '''
-        Results of Restaurants
-        '''
-        # Result exmaple
-        # i.e. Total Restaurants numbers in Detroit: [(696, 'Detroit')]
-        # i.e. Average Rating in Detroit: [(3.9331896551724137, 'Detroit')]
-        detroit_result = restaurants_query_process('detroit', data_selection)[0][0]
-        user_result = restaurants_query_process(user_city_results_lower, data_selection)[0][0]
-
-        if type(detroit_result) is float:
-            detroit_result = float_formatting(detroit_result)
-        if type(user_result) is float:
-            user_result = float_formatting(user_result)
+        # The restaurants are loaded by the background job started on the options page (or now, if it
+        # did not run or the data got old). Wait a little for it, then let the browser poll the job.
+        prefetch_job = prefetch_restaurants(user_city_results_lower)
+        prefetch_loading = False
+        if prefetch_job is not None:
+            try:
+                prefetch_job.result(timeout=PREFETCH_WAIT_SECONDS)
+            except FutureTimeoutError:
+                prefetch_loading = True
+            except Exception as error:
+                # Show what the database has
+                print(f"Restaurants of {user_city_results} could not be loaded: {error}")
+        # No job here (or it was dropped): the restaurants may be loaded by another process serving the app
+        if prefetch_loading or get_prefetch_status(user_city_results_lower) == 'running':
+            return render_template('loading.html',
+            user_city=user_city_results,
+            category=category,
+            data_selection=data_selection,
+            barplot='barplot' in request.form.keys()
+            )
 
     # Events
-    else:
-        '''
-        Events Crawling and Scraping should be already done in the main section.
-        '''
-
-        '''
-        Results of Events
-        '''
-        # Result exmaple
-        # i.e. Total Events numbers in Detroit: [(180, 'Detroit')]
-        detroit_result = events_query_process('detroit', data_selection)[0][0]
-        user_result = events_query_process(user_city_results_lower, data_selection)[0][0]
+    # => Events Crawling and Scraping should be already done in the main section.
 
     # barplot -> True or False
     barplot = 'barplot' in request.form.keys()
 
+    # The same comparison is only computed and rendered again when the data of one of the cities changed
+    results_key = (user_city_results, data_selection, barplot)
+    results_version = get_city_stats_version(['detroit', user_city_results_lower])
+    results_page = get_cached_results(results_key, results_version)
+    if results_page is not None:
+        return results_page
+
+    '''
+    Results (Detroit and the user's city in one query)
+    '''
+    # Result exmaple
+    # i.e. {'detroit': {'total_number_of_restaurants': 696}, 'ann arbor': {'total_number_of_restaurants': 410}}
+    comparison = compare_cities(['detroit', user_city_results_lower], [data_selection])
+    detroit_result = comparison['detroit'][data_selection]
+    user_result = comparison[normalize_location_name(user_city_results_lower)][data_selection]
+
+    if type(detroit_result) is float:
+        detroit_result = float_formatting(detroit_result)
+    if type(user_result) is float:
+        user_result = float_formatting(user_result)
+
     if barplot:
         x_axis = [user_city_results, 'Detroit']
         y_axis = [user_result, detroit_result]
 
+        import plotly.graph_objects as go
+
         barplot_data = go.Bar(x=x_axis, y=y_axis)
         basic_layout = go.Layout(title=f"{data_selection_configured}: {user_city_results} v.s. Detroit")
         fig = go.Figure(data=barplot_data, layout=basic_layout)
 
-        div = fig.to_html(full_html=False)
+        # plotly.js is loaded by the template from the plotly_js route
+        div = fig.to_html(full_html=False, include_plotlyjs=False)
 
-        return render_template('results.html', data_selection=data_selection_configured, barplot=barplot, plot_div=div)
+        results_page = render_template('results.html', data_selection=data_selection_configured, barplot=barplot, plot_div=div,
+        plotly_version=get_plotly_version()
+        )
 
     else:
-        return render_template('results.html', 
+        results_page = render_template('results.html', 
         user_city=user_city_results, 
         data_selection=data_selection_configured,
         detroit_result=detroit_result,
@@ -1027,15 +3325,251 @@ def results(category):
         barplot=barplot
         )
 
+    store_results(results_key, results_version, results_page)
+    return results_page
+
+# plotly.js
+@app.route('/plotly.min.js')
+def plotly_js():
+    ''' Return the plotly.js library used by the bar graphs, cacheable by the browser for a year
+    (the results page adds the plotly version to the url).
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    javascript
+        the minified plotly.js bundled with the installed plotly
+    '''
+    global PLOTLY_JS
+
+    if PLOTLY_JS is None:
+        from plotly.offline import get_plotlyjs
+
+        PLOTLY_JS = get_plotlyjs()
+
+    response = app.response_class(PLOTLY_JS, mimetype='application/javascript')
+    response.cache_control.public = True
+    response.cache_control.max_age = PLOTLY_JS_MAX_AGE_SECONDS
+    response.add_etag()
+    return response.make_conditional(request)
+
+# Batch Comparison
+def get_list_argument(name):
+    '''Read a list argument of the request: a list in the JSON body, or query/form values
+    (repeated and/or comma separated).
+    i.e. ?cities=Ann Arbor,Lansing&cities=Flint -> ['Ann Arbor', 'Lansing', 'Flint']
+
+    Parameters
+    ----------
+    name: string
+        name of the argument
+
+    Returns
+    -------
+    list
+        the non-empty values without leading/trailing spaces
+    '''
+    if request.is_json:
+        # A JSON body that is not an object is rejected by get_batch_comparison
+        json_body = request.get_json(silent=True)
+        values = json_body.get(name, []) if isinstance(json_body, dict) else []
+        if isinstance(values, str):
+            values = values.split(',')
+    else:
+        values = []
+        for value in request.values.getlist(name):
+            values.extend(value.split(','))
+
+    return [value.strip() for value in values if isinstance(value, str) and value.strip()]
+
+
+def get_batch_comparison():
+    '''Read and check the cities, data selections (metrics) and state of a batch comparison request,
+    then compare the cities (see compare_city_batch). No metrics -> every data selection.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    dict
+        i.e. {'state': 'MI', 'metrics': ['total_number_of_events'], 'cities': ['Ann Arbor', 'Lansing'],
+              'results': {'Ann Arbor': {'total_number_of_events': 61}, 'Lansing': {'total_number_of_events': 40}},
+              'pending': []}
+        or {'error': message} if the request is not valid
+    '''
+    if request.is_json:
+        json_body = request.get_json(silent=True)
+        if not isinstance(json_body, dict):
+            return {'error': "The JSON body must be an object"}
+        state_name = json_body.get('state', 'MI')
+    else:
+        state_name = request.values.get('state', 'MI')
+    state_name = str(state_name).upper()
+
+    # Each city once, in the request order
+    cities = list(dict.fromkeys(capitalize_city_name(normalize_location_name(a_city)) for a_city in get_list_argument('cities')))
+    data_selections = list(dict.fromkeys(get_list_argument('metrics'))) or list(DATA_SELECTION_COLUMNS)
+
+    if not cities:
+        return {'error': "No cities given"}
+    if len(cities) > COMPARE_MAX_CITIES:
+        return {'error': f"At most {COMPARE_MAX_CITIES} cities can be compared at once"}
+    unknown_cities = [a_city for a_city in cities if not get_city_index().contains(state_name, a_city)]
+    if unknown_cities:
+        return {'error': f"Unknown cities in {state_name}: {', '.join(unknown_cities)}"}
+    unknown_data_selections = [data_selection for data_selection in data_selections if data_selection not in DATA_SELECTION_COLUMNS]
+    if unknown_data_selections:
+        return {'error': f"Unknown metrics: {', '.join(unknown_data_selections)}"}
+
+    comparison, pending_cities = compare_city_batch(cities, data_selections, state=state_name)
+
+    return {
+        'state': state_name,
+        'metrics': data_selections,
+        'cities': cities,
+        'results': {a_city: comparison[normalize_location_name(a_city)] for a_city in cities},
+        'pending': pending_cities,
+    }
+
+@app.route('/api/compare', methods=['GET', 'POST'])
+def api_compare():
+    ''' Return the comparison of many cities on many data selections as JSON.
+
+    Parameters
+    ----------
+    None (query string, form or JSON body: cities -> city names, metrics -> data selections
+    (default: all), state -> two character state (default MI))
+
+    Returns
+    -------
+    json
+        i.e. {"state": "MI", "metrics": ["total_number_of_events"], "cities": ["Ann Arbor", "Lansing"],
+              "results": {"Ann Arbor": {"total_number_of_events": 61}, "Lansing": {"total_number_of_events": 40}},
+              "pending": []}
+        or {"error": "..."} with status 400
+    '''
+    batch_comparison = get_batch_comparison()
+    if 'error' in batch_comparison:
+        return jsonify(batch_comparison), 400
+    return jsonify(batch_comparison)
+
+@app.route('/compare')
+def compare():
+    ''' Control the batch comparison page and return 'compare.html' template: a form of cities and
+    data selections, and a table of the comparison once it is submitted.
+
+    Parameters
+    ----------
+    None (query string: same as /api/compare)
+
+    Returns
+    -------
+    html template
+        return 'compare.html' template with parameters.
+    '''
+    data_selection_titles = {data_selection: configure_data_selection(data_selection) for data_selection in DATA_SELECTION_COLUMNS}
+
+    if not request.args.get('cities'):
+        return render_template('compare.html', data_selection_titles=data_selection_titles, batch_comparison=None)
+
+    batch_comparison = get_batch_comparison()
+    if 'error' not in batch_comparison:
+        for city_results in batch_comparison['results'].values():
+            for data_selection, value in city_results.items():
+                if type(value) is float:
+                    city_results[data_selection] = float_formatting(value)
+
+    return render_template('compare.html', data_selection_titles=data_selection_titles, batch_comparison=batch_comparison,
+    cities_input=request.args.get('cities', '')
+    )
+
+# Prefetch Status
+@app.route('/prefetch/status')
+def prefetch_status():
+    ''' Return the status of the restaurant prefetch job of a city as JSON (polled by the loading page).
+
+    Parameters
+    ----------
+    None (query string: city -> city name, state -> two character state (default MI))
+
+    Returns
+    -------
+    json
+        i.e. {"city": "Ann Arbor", "state": "MI", "status": "running"}
+    '''
+    city_name = request.args.get('city', '')
+    state_name = request.args.get('state', 'MI')
+
+    return jsonify({'city': city_name, 'state': state_name, 'status': get_prefetch_status(city_name, state_name)})
+
+@app.route('/prefetch/failed')
+def prefetch_failed():
+    ''' Return 'error.html' template when the restaurant prefetch job of a city failed (shown by the loading page
+    instead of posting the results form again, which would start the job again).
+
+    Parameters
+    ----------
+    None (query string: city -> city name)
+
+    Returns
+    -------
+    html template
+        return 'error.html' template with a message, status 503
+    '''
+    city_name = request.args.get('city', '')
+
+    return render_template('error.html', message=f'the restaurants of "{city_name}" could not be loaded from Yelp, please try again later'), 503
+
+# Cache Statistics
+@app.route('/cache/stats')
+def cache_stats():
+    ''' Return the request cache counters (hits, misses, expired, evictions) and size as JSON.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    json
+        i.e. {"hits": 52, "misses": 20, "expired": 0, "evictions": 0, "entries": 72, "bytes": 3012345}
+    '''
+    if isinstance(CACHE_DICT, SqliteCache):
+        return jsonify(CACHE_DICT.get_stats())
+    return jsonify({'entries': len(CACHE_DICT)})
+
+
+'''
+Startup (command line)
+'''
+def load_startup_data():
+    '''Create (or migrate) the database, and load the data needed before a user enters a city:
+    the cities, the Michigan events and the Detroit restaurants (each only if it got old).
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    '''
+    global CACHE_DICT
 
-if __name__ == "__main__":
     '''
     Part 4: Database Accessing
     '''
-    # Create the database tables
+    # Create the database tables (or migrate the existing ones, keeping their data)
     create_db()
-    # Insert Cities Data to the database
+    # Insert Cities Data to the database (only the first time)
     load_locations()
+    # Build the city index used to check the user's city
+    get_city_index()
 
     '''
     Part 2: Caching
@@ -1049,37 +3583,157 @@ if __name__ == "__main__":
     his/her city in MI.
     '''
     '''
-    Events in Michigan
+    Events in Michigan (and the other states of EVENT_CRAWL_STATES)
     '''
-    crawl_event_pages(MICHIGAN_EVENT_URL, state_event_crawling_numbers)
+    # The crawled events are streamed straight into the database (unless they were loaded recently)
+    if events_need_refresh(EVENT_CRAWL_STATES):
+        try:
+            # Insert State Events records to the database (and delete the ones not listed anymore)
+            events_count, deleted_events_count = refresh_events(EVENT_CRAWL_STATES, EVENTBRITE_STATE_URL)
+            print(f"total # of {', '.join(EVENT_CRAWL_STATES)} events data: {events_count} ({deleted_events_count} old events deleted)")
+        except requests.RequestException as error:
+            # The app serves the events already in the database, the refresh scheduler tries again
+            print(f"Crawling the events failed: {error}")
 
-    michigan_all_events = []
+    '''
+    Detroit's City's Restaurant
+    '''
+    # Insert Detroit Restaurants records to the database (unless they were loaded recently)
+    if needs_refresh("detroit", 'yelp', RESTAURANT_REFRESH_SECONDS):
+        # Streamed from YELP Fusion API into the database
+        detroit_restaurants_count = fetch_and_load_restaurants("detroit")
+        print(f"total # of restaurants in detroit: {detroit_restaurants_count}")
 
-    for i in range(len(event_names)):
-        a_event_dict = {}
-        a_event_dict["event_name"] = event_names[i]
-        a_event_dict["event_location"] = event_location[i]
-        a_event_dict["event_city"] = event_city[i]
-        a_event_dict["event_state"] = event_state[i]
-        a_event_dict["event_day"] = event_day[i]
-        a_event_dict["event_date"] = event_date[i]
-        a_event_dict["event_time"] = event_time[i]
-        michigan_all_events.append(a_event_dict)
+    if isinstance(CACHE_DICT, SqliteCache):
+        print(f"Cache stats: {CACHE_DICT.get_stats()}")
 
-    print(f"total # of michigan events data: {len(michigan_all_events)}")
 
-    # Insert Michigan State Events records to the database
-    load_events(michigan_all_events)
+def build_snapshot(snapshot_filename=DB_SNAPSHOT_FILENAME):
+    '''Write a compact, self-contained copy of the database (no WAL files, fresh query planner
+    statistics) that "serve" can open read-only.
 
+    Parameters
+    ----------
+    snapshot_filename: string
+        path of the snapshot (replaced if it exists)
+
+    Returns
+    -------
+    int
+        size of the snapshot in bytes
     '''
-    Detroit's City's Restaurant
-    '''
-    # Insert Detroit Restaurants records to the database
-    detroit_restaurants = get_restaurant_information("detroit")
-    print(f"total # of restaurants in detroit + near detroit raw data: {len(detroit_restaurants)}")
-    load_restaurants(detroit_restaurants, "detroit")
+    if os.path.exists(snapshot_filename):
+        os.remove(snapshot_filename)
+
+    conn = open_db_connection()
+    conn.execute('ANALYZE')
+    conn.commit()
+    # VACUUM INTO writes a defragmented copy in rollback journal mode
+    conn.execute('VACUUM INTO ?', [snapshot_filename])
+    conn.close()
+
+    return os.path.getsize(snapshot_filename)
 
+
+def attach_snapshot(snapshot_filename=DB_SNAPSHOT_FILENAME):
+    '''Serve the data of a snapshot: every connection opens it read-only, and nothing is
+    crawled, fetched, migrated or refreshed.
+
+    Parameters
+    ----------
+    snapshot_filename: string
+        path of a snapshot written by build_snapshot
+
+    Returns
+    -------
+    None
     '''
-    Part 6 Data Presentation
+    global DB_NAME, DB_READ_ONLY
+
+    if not os.path.exists(snapshot_filename):
+        raise FileNotFoundError(f"No database snapshot at {snapshot_filename}, run the build-snapshot command first")
+
+    DB_NAME = snapshot_filename
+    DB_READ_ONLY = True
+
+    schema_version = get_db_connection().execute('PRAGMA user_version').fetchone()[0]
+    if schema_version != len(SCHEMA_MIGRATIONS):
+        raise ValueError(f"The snapshot has schema version {schema_version}, "
+                         f"this app needs {len(SCHEMA_MIGRATIONS)}: build the snapshot again")
+
+
+def main():
+    '''Command line of the app.
+        python city_comparing.py                  -> load the data (if it got old) and serve it, refreshed in the background
+        python city_comparing.py build-snapshot   -> load the data and write DB_SNAPSHOT_FILENAME
+        python city_comparing.py serve            -> serve DB_SNAPSHOT_FILENAME as it is (fast startup)
+        python city_comparing.py precompute       -> load the restaurants of every Michigan city (resumable)
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
     '''
-    app.run(debug=False)
\ No newline at end of file
+    global EVENT_CRAWL_STATES, EVENT_CRAWL_MAX_PAGES
+
+    parser = argparse.ArgumentParser(description="City Compare Flask app")
+    parser.add_argument('--event-states', default=",".join(EVENT_CRAWL_STATES),
+                        help="comma separated states whose events are crawled (i.e. MI,OH,IN)")
+    parser.add_argument('--event-max-pages', type=int, default=EVENT_CRAWL_MAX_PAGES,
+                        help="the most event pages crawled per state")
+    subparsers = parser.add_subparsers(dest='command')
+
+    snapshot_parser = subparsers.add_parser('build-snapshot', help="load the data and write a database snapshot")
+    snapshot_parser.add_argument('--output', default=DB_SNAPSHOT_FILENAME)
+
+    serve_parser = subparsers.add_parser('serve', help="serve a database snapshot read-only")
+    serve_parser.add_argument('--snapshot', default=DB_SNAPSHOT_FILENAME)
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=5000)
+
+    precompute_parser = subparsers.add_parser('precompute', help="load the restaurants of every city of a state")
+    precompute_parser.add_argument('--state', default='MI')
+    precompute_parser.add_argument('--limit', type=int, help="only the most populated cities")
+    precompute_parser.add_argument('--workers', type=int, default=PRECOMPUTE_MAX_WORKERS)
+
+    args = parser.parse_args()
+    EVENT_CRAWL_STATES = [state_name.strip().upper() for state_name in args.event_states.split(',') if state_name.strip()]
+    # Read by refresh_events when it starts a crawl (the crawl_states workers get it as an argument)
+    EVENT_CRAWL_MAX_PAGES = args.event_max_pages
+
+    if args.command == 'precompute':
+        load_startup_data()
+        summary = precompute_restaurants(args.state, limit=args.limit, max_workers=args.workers)
+        print(f"Loaded {summary['loaded']} cities, {summary['skipped']} already loaded, {len(summary['failed'])} failed")
+        if summary['failed']:
+            print(f"Failed cities (run the command again to retry): {', '.join(summary['failed'])}")
+
+    elif args.command == 'build-snapshot':
+        load_startup_data()
+        snapshot_size = build_snapshot(args.output)
+        print(f"Wrote {args.output} ({snapshot_size} bytes)")
+
+    elif args.command == 'serve':
+        attach_snapshot(args.snapshot)
+
+        '''
+        Part 6 Data Presentation
+        '''
+        app.run(host=args.host, port=args.port, debug=False)
+
+    else:
+        load_startup_data()
+        # Keep the events and the restaurants fresh while the app is running
+        start_refresh_scheduler()
+
+        '''
+        Part 6 Data Presentation
+        '''
+        app.run(debug=False)
+
+
+if __name__ == "__main__":
+    main()